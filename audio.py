@@ -0,0 +1,156 @@
+"""
+single pass audio assembly for the podcast
+
+    every fragment is decoded once and its pcm is streamed, in order, with the gaps and
+    crossfades applied on the way. the timeline mixes and encodes one segment of the episode
+    at a time from it, so a 3 hour episode costs about as much memory as a 10 minute one.
+"""
+
+import os
+import shutil
+import typing
+import wave
+from dataclasses import dataclass, field
+from typing import List
+
+from tracing import tracer
+
+
+@dataclass
+class AudioPart:
+    path: str
+    # silence after this part, None falls back to the assembler's gap_ms
+    gap_after_ms: typing.Optional[int] = None
+    # already decoded pcm in the assembler's format, path is then only used as a label
+    pcm: typing.Optional[bytes] = None
+
+
+@dataclass
+class AssemblyStats:
+    sample_rate: int
+    channels: int
+    frames: int = 0
+    # (start frame, frame count) of every part in the output
+    offsets: List[typing.Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def duration_ms(self) -> int:
+        return self.frames * 1000 // self.sample_rate
+
+
+def read_pcm(path: str, *, sample_rate: int, channels: int, sample_width: int = 2) -> bytes:
+    """
+        decode an audio file to raw little endian pcm in the requested format
+        wavs that already match are read directly, anything else goes through pydub / ffmpeg
+    """
+    try:
+        with wave.open(path, "rb") as w:
+            if (w.getframerate(), w.getnchannels(), w.getsampwidth()) == (sample_rate, channels, sample_width):
+                return w.readframes(w.getnframes())
+    except (wave.Error, EOFError):
+        pass
+
+    from pydub import AudioSegment
+
+    segment = AudioSegment.from_file(path)
+    segment = segment.set_frame_rate(sample_rate).set_channels(channels).set_sample_width(sample_width)
+
+    return segment.raw_data
+
+
+def find_ffmpeg() -> str:
+    ffmpeg = shutil.which("ffmpeg")
+
+    if ffmpeg is None:
+        import imageio_ffmpeg
+
+        ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+
+    return ffmpeg
+
+
+def crossfade(tail: bytes, head: bytes) -> bytes:
+    """
+        linear crossfade of two equally long 16bit pcm buffers
+    """
+    import numpy as np
+
+    a = np.frombuffer(tail, dtype=np.int16).astype(np.float32)
+    b = np.frombuffer(head, dtype=np.int16).astype(np.float32)
+    ramp = np.linspace(0.0, 1.0, num=len(a), endpoint=False, dtype=np.float32)
+
+    return np.clip(a * (1.0 - ramp) + b * ramp, -32768, 32767).astype(np.int16).tobytes()
+
+
+class AudioAssembler:
+    """
+        joins parts with explicit gap and crossfade settings ( a crossfade only applies to joins without a gap )
+    """
+
+    def __init__(self, *, sample_rate: int = 24000, channels: int = 1, gap_ms: int = 0, crossfade_ms: int = 0) -> None:
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.gap_ms = gap_ms
+        self.crossfade_ms = crossfade_ms
+
+    def _frames_to_bytes(self, frames: int) -> int:
+        return frames * self.channels * 2
+
+    def _ms_to_bytes(self, ms: int) -> int:
+        return self._frames_to_bytes(self.sample_rate * ms // 1000)
+
+    def iter_pcm(self, parts: typing.Iterable[typing.Union[AudioPart, str]], stats: typing.Optional[AssemblyStats] = None) -> typing.Iterator[bytes]:
+        frame_size = self._frames_to_bytes(1)
+        crossfade_bytes = self._ms_to_bytes(self.crossfade_ms)
+        written = 0
+
+        # the end of the previous part, kept back so it can be blended into the next one
+        tail = b""
+
+        for part in parts:
+            if isinstance(part, str):
+                part = AudioPart(path=part)
+
+            if part.pcm is not None:
+                pcm = part.pcm
+            else:
+                with tracer.span("audio.decode", path=os.path.basename(part.path)) as span:
+                    pcm = read_pcm(part.path, sample_rate=self.sample_rate, channels=self.channels)
+                    span.set(bytes=len(pcm))
+
+            start = written + len(tail)
+
+            if tail:
+                overlap = min(len(tail), len(pcm)) // frame_size * frame_size
+
+                yield tail[:len(tail) - overlap]
+                yield crossfade(tail[len(tail) - overlap:], pcm[:overlap])
+
+                written += len(tail)
+                start -= overlap
+                pcm = pcm[overlap:]
+                tail = b""
+
+            gap_ms = self.gap_ms if part.gap_after_ms is None else part.gap_after_ms
+            keep = 0 if gap_ms > 0 else min(crossfade_bytes, len(pcm)) // frame_size * frame_size
+
+            body = pcm[:len(pcm) - keep]
+            tail = pcm[len(pcm) - keep:] if keep else b""
+
+            yield body
+            written += len(body)
+
+            if stats is not None:
+                stats.offsets.append((start // frame_size, (written + len(tail)) // frame_size - start // frame_size))
+
+            if gap_ms > 0:
+                silence = bytes(self._ms_to_bytes(gap_ms))
+                yield silence
+                written += len(silence)
+
+        if tail:
+            yield tail
+            written += len(tail)
+
+        if stats is not None:
+            stats.frames = written // frame_size
@@ -0,0 +1,224 @@
+"""
+batch episode runner
+
+    reads a jsonl file of episode specs and renders them over a process pool
+
+        {"name": "Dingo and the Baby", "title": "food", "participants": [{"name": "Sharon", "role": "Host", "gender": "female", "voice": "en-GB-SoniaNeural"}], "sponsors": [{"message": "Blueband, the best jam to use"}]}
+
+    every episode gets its own folder with a checkpoint.json, the stages ( script -> fragments -> mix -> video )
+    are recorded as they finish so a killed batch picks every episode up from its last finished stage
+
+    python batch.py episodes.jsonl --output episodes --workers 2
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+import traceback
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from os.path import join
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from files import atomic_write
+from main import ConversationWithMergedMusic, Participant, SponsorMessage, TextToPodcast
+from tracing import tracer
+
+
+STAGES = ("script", "fragments", "mix", "video")
+
+
+class EpisodeSpec(BaseModel):
+    name: str = Field(description="name of the podcast")
+    title: str = Field(description="title of the episode")
+    participants: List[Participant] = Field(description="the participants of the episode")
+    sponsors: List[SponsorMessage] = Field(default_factory=list, description="sponsor messages to be read in the episode")
+    material_location: typing.Optional[str] = Field(default=None, description="a pdf or web page the episode should be based on")
+    id: typing.Optional[str] = Field(default=None, description="folder name of the episode, derived from the name and title if missing")
+
+    @property
+    def episode_id(self) -> str:
+        return self.id or slugify(f"{self.name}-{self.title}")
+
+
+def slugify(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-") or "episode"
+
+
+class EpisodeCheckpoint:
+    def __init__(self, work_dir: str) -> None:
+        self.work_dir = work_dir
+        self.path = join(work_dir, "checkpoint.json")
+        self.stages: typing.Dict[str, dict] = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.stages = json.load(f)["stages"]
+
+    def done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def get(self, stage: str) -> dict:
+        return self.stages[stage]
+
+    def complete(self, stage: str, **data) -> None:
+        self.stages[stage] = {**data, "completed_at": time.time()}
+
+        # written to a temp file first so a kill mid write never corrupts the checkpoint
+        with atomic_write(self.path, "w") as f:
+            json.dump({"stages": self.stages}, f, indent=2)
+
+
+@dataclass
+class EpisodeResult:
+    episode_id: str
+    ok: bool
+    # stage -> seconds spent on it in this run, stages restored from a checkpoint are not listed
+    timings: typing.Dict[str, float] = field(default_factory=dict)
+    resumed_from: typing.Optional[str] = None
+    error: typing.Optional[str] = None
+
+
+_podcast: typing.Optional[TextToPodcast] = None
+
+
+def _init_worker() -> None:
+    # one TextToPodcast per process, the tts pools and caches are reused across episodes
+    global _podcast
+    _podcast = TextToPodcast()
+
+
+def render_episode(spec: EpisodeSpec, work_dir: str, podcast: typing.Optional[TextToPodcast] = None) -> EpisodeResult:
+    podcast = podcast or _podcast
+    os.makedirs(work_dir, exist_ok=True)
+
+    checkpoint = EpisodeCheckpoint(work_dir)
+    started_at = time.time()
+    result = EpisodeResult(episode_id=spec.episode_id, ok=False)
+    finished = [stage for stage in STAGES if checkpoint.done(stage)]
+    result.resumed_from = finished[-1] if finished else None
+
+    def _timed(stage: str, run: typing.Callable[[], dict]) -> None:
+        if checkpoint.done(stage):
+            return
+
+        started = time.perf_counter()
+        data = run()
+        result.timings[stage] = time.perf_counter() - started
+
+        checkpoint.complete(stage, **data)
+
+    try:
+        script_file = join(work_dir, "script.json")
+
+        def _script() -> dict:
+            podcast_script = podcast.generate_script(
+                name=spec.name, title=spec.title, participants=spec.participants, sponsors=spec.sponsors,
+                material_location=spec.material_location
+            )
+
+            with open(script_file, "w") as f:
+                f.write(podcast_script.json())
+
+            return {"file": "script.json"}
+
+        _timed("script", _script)
+
+        podcast_script = ConversationWithMergedMusic.parse_file(script_file)
+
+        def _fragments() -> dict:
+            report = podcast.synthesize_fragments(podcast_script=podcast_script, fragments_dir=join(work_dir, "fragments"))
+
+            if not report.ok:
+                # not checkpointed, a resume retries the failed lines ( the rest come out of the fragment cache )
+                raise RuntimeError(f"{len(report.failures)} lines failed to synthesize")
+
+            return {
+                "fragments": [os.path.relpath(report.fragments[i], work_dir) for i in sorted(report.fragments)],
+                "lines": sorted(report.fragments)
+            }
+
+        _timed("fragments", _fragments)
+
+        audio_file = join(work_dir, f"{spec.episode_id}.mp3")
+
+        def _mix() -> dict:
+            fragments = [join(work_dir, f) for f in checkpoint.get("fragments")["fragments"]]
+            music = podcast.music_cues(podcast_script, checkpoint.get("fragments").get("lines"))
+            stats = podcast.mix_podcast(fragments=fragments, audio_file=audio_file, music=music)
+
+            return {"file": os.path.basename(audio_file), "duration_ms": stats.duration_ms}
+
+        _timed("mix", _mix)
+
+        def _video() -> dict:
+            video_file = join(work_dir, f"{spec.episode_id}.mp4")
+            outputs = podcast.render_video(title=podcast_script.title, audio_file=audio_file, video_file=video_file)
+
+            return {"files": {target: os.path.basename(f) for target, f in outputs.items()}}
+
+        _timed("video", _video)
+
+        result.ok = True
+
+    except Exception:
+        result.error = traceback.format_exc()
+
+    # spans of this run only, the worker process renders one episode at a time
+    tracer.write_json(join(work_dir, "trace.json"), since=started_at)
+
+    return result
+
+
+def read_specs(path: str) -> List[EpisodeSpec]:
+    with open(path) as f:
+        return [EpisodeSpec.parse_raw(line) for line in f if line.strip()]
+
+
+def run_batch(specs: List[EpisodeSpec], *, output_dir: str, workers: int = 2) -> List[EpisodeResult]:
+    started = time.perf_counter()
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {
+            executor.submit(render_episode, spec, join(output_dir, spec.episode_id)): spec
+            for spec in specs
+        }
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            if result.ok:
+                print(f"[done] {result.episode_id} (resumed after {result.resumed_from or 'nothing'}) " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in result.timings.items()))
+            else:
+                print(f"[failed] {result.episode_id}\n{result.error}")
+
+    elapsed = time.perf_counter() - started
+    completed = sum(1 for r in results if r.ok)
+
+    print(f"{completed}/{len(results)} episodes in {elapsed:.1f}s ({completed / (elapsed / 3600) if elapsed > 0 else 0:.2f} episodes/hour)")
+
+    for stage in STAGES:
+        spent = [r.timings[stage] for r in results if stage in r.timings]
+
+        if spent:
+            print(f"    {stage}: {len(spent)} runs, {sum(spent) / len(spent):.1f}s average")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render a batch of podcast episodes")
+    parser.add_argument("specs", help="jsonl file with one episode spec per line")
+    parser.add_argument("--output", default="episodes", help="folder the episodes ( and their checkpoints ) are written to")
+    parser.add_argument("--workers", type=int, default=2, help="number of episodes rendered in parallel")
+
+    args = parser.parse_args()
+
+    run_batch(read_specs(args.specs), output_dir=args.output, workers=args.workers)
@@ -0,0 +1,435 @@
+"""
+offline benchmark for the audio and scheduling hot paths
+
+    builds a synthetic script of configurable length and runs it through every stage of
+    generate_podcast_resources with fake llm, tts and image backends ( deterministic wavs / pngs,
+    no network access needed ). each stage is timed separately together with the rss it
+    leaves behind, the peak rss is reported for the whole run.
+
+    python benchmark.py --lines 400 --tts-latency 0.05 --output bench.json
+    python benchmark.py --lines 400 --tts-latency 0.05 --compare bench.json
+
+    results are saved as json ( with the current commit ) so runs can be compared between commits
+"""
+
+import argparse
+import inspect
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import zlib
+from os.path import join
+
+from fragment_cache import FragmentCache
+from llm_cache import LLMResponseCache
+from main import (
+    Conversation, ConversationPiece, ConversationWithMergedMusic, LineRewrite, Music, MusicInsertion,
+    MusicPlacement, TextToPodcast, merge_music_placement
+)
+from music_library import open_library
+from tracing import tracer
+from tts import FakeSpeechBackend, write_tone_wav
+
+
+# importing main and building a TextToPodcast must stay within this, the heavy dependencies are imported lazily
+STARTUP_BUDGET = {"seconds": 1.0, "import_rss_mb": 100.0}
+
+# none of these should be loaded before a stage needs them
+HEAVY_MODULES = ["langchain", "openai", "azure.cognitiveservices.speech", "moviepy", "spotdl", "replicate", "pydub", "numpy"]
+
+_STARTUP_PROBE = """
+import json, os, sys, time
+
+# current_rss_mb is prepended, ru_maxrss would carry over the parent's high water mark across fork / exec
+rss_before = current_rss_mb()
+started = time.perf_counter()
+
+import main
+
+imported = time.perf_counter()
+main.TextToPodcast()
+constructed = time.perf_counter()
+
+print(json.dumps({
+    "import_seconds": imported - started,
+    "seconds": constructed - started,
+    "import_rss_mb": current_rss_mb() - rss_before,
+    "modules": len(sys.modules),
+    "heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules],
+}))
+"""
+
+VOICES = ["en-GB-SoniaNeural", "en-GB-RyanNeural", "en-GB-BellaNeural", "en-GB-OliverNeural"]
+SPEAKERS = ["Sharon", "Brian", "Emma", "John"]
+WORDS = "the of podcast food people really think about why that would honestly [laughs] AMAZING story music remember".split()
+
+
+def synthetic_script(*, lines: int, music_every: int = 40, seed: int = 0) -> typing.Tuple[Conversation, MusicPlacement]:
+    """
+        the first pass script plus the music placement delta the second pass would return
+    """
+    rng = random.Random(seed)
+
+    conversation = [
+        ConversationPiece(
+            speakers_name=SPEAKERS[i % len(SPEAKERS)],
+            speaker_voice=VOICES[i % len(VOICES)],
+            line=" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 40)))
+        )
+        for i in range(lines)
+    ]
+
+    positions = list(range(music_every - 1, lines - 1, music_every)) if music_every > 0 else []
+
+    script = Conversation(
+        title=f"benchmark episode {lines}",
+        description="a synthetic episode",
+        music_theme="calm lofi",
+        music_to_be_played=[Music(theme=f"theme {p}", position=p) for p in positions],
+        conversation=conversation
+    )
+
+    placement = MusicPlacement(
+        music=[
+            MusicInsertion(after_line=p, music_theme=f"theme {p}", mode="background" if n % 2 else "foreground", volume_level=0.3, what_percentage=0.2)
+            for n, p in enumerate(positions)
+        ],
+        rewrites=[LineRewrite(line=p, text=f"{conversation[p].line} and now some music") for p in positions]
+    )
+
+    return (script, placement)
+
+
+class _FakeGeneration:
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class _FakeLLMResult:
+    def __init__(self, text: str) -> None:
+        self.generations = [[_FakeGeneration(text)]]
+        self.llm_output = {"token_usage": {"prompt_tokens": 0, "completion_tokens": len(text) // 4}}
+
+
+class FakeChatModel:
+    """
+        answers the script pass with the synthetic script and the music pass with its placement delta
+        ( or the merged script for music_pass="full" ), streamed in small chunks when callbacks are passed
+    """
+
+    model_name = "fake"
+    temperature = 0.0
+    max_tokens = 0
+
+    def __init__(self, script: Conversation, placement: MusicPlacement, *, streaming: bool = False, chunk_size: int = 16) -> None:
+        self.script = script
+        self.placement = placement
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+
+    def copy(self, update: typing.Optional[dict] = None) -> "FakeChatModel":
+        return FakeChatModel(self.script, self.placement, chunk_size=self.chunk_size, **(update or {}))
+
+    def generate(self, messages, callbacks=None) -> _FakeLLMResult:
+        prompt = messages[0][-1].content
+
+        if "numbered podcast script" in prompt:
+            text = self.placement.json()
+        elif "add sections in the conversation" in prompt:
+            text = merge_music_placement(self.script, self.placement).json()
+        else:
+            text = self.script.json()
+
+        for callback in callbacks or []:
+            for i in range(0, len(text), self.chunk_size):
+                callback.on_llm_new_token(text[i:i + self.chunk_size])
+
+        return _FakeLLMResult(text)
+
+
+def write_png(png_file: str, *, width: int = 1024, height: int = 1024, seed: str = "") -> str:
+    # a flat colour derived from the seed, enough for the video stage
+    (r, g, b) = zlib.crc32(seed.encode("utf-8")).to_bytes(4, "big")[:3]
+    row = b"\x00" + bytes((r, g, b)) * width
+
+    def _chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(png_file, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(_chunk(b"IDAT", zlib.compress(row * height)))
+        f.write(_chunk(b"IEND", b""))
+
+    return png_file
+
+
+def write_music(music_dir: str, placement: MusicPlacement, *, seconds: int) -> None:
+    # one tone track per theme, named after it so the music lookup finds it
+    os.makedirs(music_dir, exist_ok=True)
+
+    for m in placement.music:
+        write_tone_wav(join(music_dir, f"{m.music_theme}.wav"), seed=m.music_theme, duration_ms=seconds * 1000)
+
+
+class BenchmarkPodcast(TextToPodcast):
+    # simulated image generation round trip, the video is skipped entirely without ffmpeg
+    image_latency = 0.0
+    skip_video = False
+
+    def generate_cover(self, *, title: str, cover_file: str) -> str:
+        with tracer.span("image.generate"):
+            time.sleep(self.image_latency)
+
+            return write_png(cover_file, seed=title)
+
+    def render_video(self, **kwargs) -> typing.Dict[str, str]:
+        return {} if self.skip_video else super().render_video(**kwargs)
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        import psutil
+
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def current_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_startup(repeat: int = 3) -> dict:
+    """
+        import main and build a TextToPodcast in a fresh interpreter, the fastest of the runs is kept
+    """
+    probe = f"HEAVY_MODULES = {HEAVY_MODULES!r}\n" + inspect.getsource(current_rss_mb) + _STARTUP_PROBE
+    runs = []
+
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", probe], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    startup = min(runs, key=lambda run: run["seconds"])
+    startup["within_budget"] = all(startup[key] <= limit for key, limit in STARTUP_BUDGET.items()) and not startup["heavy_modules"]
+    startup["budget"] = STARTUP_BUDGET
+
+    return startup
+
+
+def run_once(args, work_dir: str, cache_dir: str) -> dict:
+    (script, placement) = synthetic_script(lines=args.lines, music_every=args.music_every, seed=args.seed)
+
+    write_music(join(work_dir, "music"), placement, seconds=args.music_seconds)
+
+    podcast = BenchmarkPodcast(
+        chat_model=FakeChatModel(script, placement),
+        speech_backend=FakeSpeechBackend(latency=args.tts_latency, failure_rate=args.tts_failure_rate, seed=args.seed),
+        max_tts_workers=args.tts_workers,
+        fragment_cache=FragmentCache(join(cache_dir, "fragments")),
+        llm_cache=LLMResponseCache(join(cache_dir, "llm"), mode="off"),
+        music_pass=args.music_pass,
+        video_targets=args.video_targets,
+        music_library=open_library(join(work_dir, "music"), index_file=join(cache_dir, "music-index.json"))
+    )
+
+    podcast.tts_scheduler.backoff = 0.01
+    podcast.tts_scheduler.batch_chars = args.tts_batch_chars
+    podcast.image_latency = args.image_latency
+    podcast.skip_video = args.skip_video
+
+    stages = {}
+    started = time.time()
+
+    def _stage(name: str, run: typing.Callable[[], typing.Any]) -> typing.Any:
+        # the peak only ever goes up, every stage after the biggest one would report its peak
+        rss_before = current_rss_mb()
+        stage_started = time.perf_counter()
+        result = run()
+        rss_after = current_rss_mb()
+
+        stages[name] = {"seconds": time.perf_counter() - stage_started, "rss_mb": rss_after, "rss_delta_mb": rss_after - rss_before}
+
+        return result
+
+    if args.pipeline:
+        # the whole episode through the stage graph, the cover overlaps the tts and the mix
+        results = _stage("pipeline", lambda: podcast.generate_podcast_resources(
+            name="benchmark", title=script.title, participants=[], stream_tts=args.stream_tts, skip_failed_lines=True, output_dir=work_dir
+        ))
+
+        (report, audio_stats) = (results["fragments"], results["mix"])
+        audio_file = join(work_dir, f"{results['script'].title}.mp3")
+    else:
+        podcast_script: ConversationWithMergedMusic = _stage("script", lambda: podcast.generate_script(
+            name="benchmark", title=script.title, participants=[], stream_tts=args.stream_tts
+        ))
+
+        report = _stage("fragments", lambda: podcast.synthesize_fragments(
+            podcast_script=podcast_script, fragments_dir=join(work_dir, "fragments")
+        ))
+
+        fragments = [report.fragments[i] for i in sorted(report.fragments)]
+        audio_file = join(work_dir, "episode.mp3")
+
+        audio_stats = _stage("mix", lambda: podcast.mix_podcast(
+            fragments=fragments, audio_file=audio_file, music=podcast.music_cues(podcast_script, report.fragments)
+        ))
+
+        cover_file = _stage("image", lambda: podcast.generate_cover(title=podcast_script.title, cover_file=join(work_dir, "episode.png")))
+
+        if not args.skip_video:
+            _stage("video", lambda: podcast.render_video(
+                title=podcast_script.title, audio_file=audio_file, video_file=join(work_dir, "episode.mp4"), cover_file=cover_file
+            ))
+
+    spans: typing.Dict[str, dict] = {}
+
+    for span in tracer.spans(since=started):
+        totals = spans.setdefault(span.name, {"count": 0, "seconds": 0.0})
+        totals["count"] += 1
+        totals["seconds"] += span.duration
+
+    return {
+        "stages": stages,
+        "spans": spans,
+        "audio_seconds": audio_stats.duration_ms / 1000,
+        "mp3_bytes": os.path.getsize(audio_file),
+        "tts_calls": podcast.speech_backend.calls,
+        "tts_failures": len(report.failures),
+        "tts_retries": report.retries,
+        "cache_hits": report.cache_hits,
+    }
+
+
+def run_benchmark(args) -> dict:
+    runs = []
+
+    with tempfile.TemporaryDirectory() as shared_cache:
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                # a cold fragment cache per run unless --warm-cache
+                cache_dir = shared_cache if args.warm_cache else join(work_dir, "cache")
+                runs.append(run_once(args, work_dir, cache_dir))
+
+    stage_names = list(runs[0]["stages"])
+
+    return {
+        "commit": current_commit(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "enforce_budget")},
+        # the median over the repeats, the raw runs are kept alongside
+        "stages": {
+            name: {
+                "seconds": statistics.median(run["stages"][name]["seconds"] for run in runs),
+                "rss_mb": max(run["stages"][name]["rss_mb"] for run in runs),
+                "rss_delta_mb": max(run["stages"][name]["rss_delta_mb"] for run in runs),
+            }
+            for name in stage_names
+        },
+        "total_seconds": statistics.median(sum(s["seconds"] for s in run["stages"].values()) for run in runs),
+        "peak_rss_mb": peak_rss_mb(),
+        "startup": measure_startup(),
+        "runs": runs,
+    }
+
+
+def print_results(results: dict, baseline: typing.Optional[dict] = None) -> None:
+    print(f"commit {results['commit']} | {results['params']['lines']} lines | {results['runs'][0]['audio_seconds']:.0f}s of audio | peak rss {results['peak_rss_mb']:.1f}MB")
+
+    for name, stage in list(results["stages"].items()) + [("total", {"seconds": results["total_seconds"]})]:
+        line = f"    {name:<10} {stage['seconds'] * 1000:10.1f}ms"
+
+        if "rss_mb" in stage:
+            line += f"   rss {stage['rss_mb']:8.1f}MB ({stage['rss_delta_mb']:+.1f}MB)"
+
+        if baseline is not None:
+            before = baseline["total_seconds"] if name == "total" else baseline["stages"].get(name, {}).get("seconds")
+
+            if before:
+                line += f"   {before * 1000:10.1f}ms before ({stage['seconds'] / before:.2f}x)"
+
+        print(line)
+
+    startup = results["startup"]
+    line = f"    {'startup':<10} {startup['seconds'] * 1000:10.1f}ms   rss {startup['import_rss_mb']:8.1f}MB   {'within' if startup['within_budget'] else 'OVER'} budget"
+
+    if baseline is not None and "startup" in baseline:
+        line += f"   {baseline['startup']['seconds'] * 1000:10.1f}ms before"
+
+    print(line)
+
+    if startup["heavy_modules"]:
+        print(f"    imported at startup: {', '.join(startup['heavy_modules'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmark of the podcast pipeline")
+    parser.add_argument("--lines", type=int, default=200, help="number of conversation lines in the synthetic script")
+    parser.add_argument("--music-every", type=int, default=40, help="insert music after every n lines, 0 for none")
+    parser.add_argument("--music-seconds", type=int, default=30, help="length of every synthetic music track")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the median is reported")
+    parser.add_argument("--tts-workers", type=int, default=4)
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="simulated seconds per tts request")
+    parser.add_argument("--tts-failure-rate", type=float, default=0.0, help="fraction of tts requests that fail as throttled")
+    parser.add_argument("--tts-batch-chars", type=int, default=3000, help="ssml size limit of a batched tts request, 0 for one request per line")
+    parser.add_argument("--music-pass", choices=["delta", "full"], default="delta")
+    parser.add_argument("--stream-tts", action="store_true", help="synthesize lines while the script streams in")
+    parser.add_argument("--warm-cache", action="store_true", help="share the fragment cache between runs")
+    parser.add_argument("--video-targets", nargs="+", default=["square"])
+    parser.add_argument("--image-latency", type=float, default=0.0, help="simulated seconds for the cover image request")
+    parser.add_argument("--pipeline", action="store_true", help="run the episode through the stage graph instead of stage by stage")
+    parser.add_argument("--skip-video", action="store_true", help="skip the video stage ( needs ffmpeg )")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="a previous results file to compare against")
+    parser.add_argument("--enforce-budget", action="store_true", help="exit with an error when startup is over budget")
+
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.enforce_budget and not results["startup"]["within_budget"]:
+        sys.exit(1)
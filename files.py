@@ -0,0 +1,30 @@
+"""
+file helpers shared by the caches, the checkpoints and the timeline
+"""
+
+import contextlib
+import os
+import tempfile
+import typing
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "wb") -> typing.Iterator[typing.IO]:
+    """
+        a file that only replaces path once it was written completely, a crash ( or an exception ) mid write
+        leaves path as it was and no temp file behind. the temp file sits next to path so os.replace is atomic
+
+            with atomic_write("manifest.json", "w") as f:
+                json.dump(manifest, f)
+    """
+    (fd, temp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
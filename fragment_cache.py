@@ -0,0 +1,158 @@
+"""
+persistent cache for synthesized speech fragments
+
+    fragments are content addressed ( voice + text + output format ) so re-rendering an
+    episode after a small script edit only hits tts for the lines that changed. sponsor
+    reads and recurring intros / outros are rendered once and reused across episodes.
+
+    writes go through a temp file + os.replace so several workers ( or processes ) can
+    share the same directory, once the cache grows past max_bytes the least recently used
+    fragments are evicted down to low_water * max_bytes ( so a full cache is not walked on every put )
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import typing
+from os.path import join
+
+from files import atomic_write
+
+
+def fragment_key(*, voice: str, text: str, output_format: str) -> str:
+    return hashlib.sha256("\0".join([output_format, voice, text]).encode("utf-8")).hexdigest()
+
+
+class FragmentCache:
+    def __init__(self, root: str, *, max_bytes: int = 2 * 1024 ** 3, low_water: float = 0.8, extension: str = ".wav") -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.extension = extension
+        self._lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+
+        self._size = sum(size for (_, size, _) in self._entries())
+
+    def _path(self, key: str) -> str:
+        return join(self.root, key[:2], key + self.extension)
+
+    def _entries(self) -> typing.List[typing.Tuple[str, int, float]]:
+        entries = []
+
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(self.extension):
+                    continue
+
+                path = join(directory, name)
+
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # evicted by another worker while we were scanning
+                    continue
+
+                entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def get(self, key: str) -> typing.Optional[str]:
+        path = self._path(key)
+
+        try:
+            # the mtime doubles as the last access time for the lru
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def fetch(self, key: str, audio_file: str) -> bool:
+        """
+            materialize a cached fragment at audio_file. it is a copy, not a hard link, the backends write
+            their output in place and would otherwise overwrite the cache entry the next time the line changes
+        """
+        path = self.get(key)
+
+        if path is None:
+            return False
+
+        try:
+            # replacing ( instead of writing into ) audio_file also detaches it from a link left by an older render
+            with atomic_write(audio_file) as dst, open(path, "rb") as src:
+                shutil.copyfileobj(src, dst)
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            return False
+
+        return True
+
+    def put(self, key: str, audio_file: str) -> str:
+        with open(audio_file, "rb") as src:
+            return self._write(key, lambda dst: shutil.copyfileobj(src, dst))
+
+    def put_bytes(self, key: str, data: bytes) -> str:
+        return self._write(key, lambda dst: dst.write(data))
+
+    def read_bytes(self, key: str) -> typing.Optional[bytes]:
+        path = self.get(key)
+
+        if path is None:
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, write: typing.Callable[[typing.BinaryIO], typing.Any]) -> str:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        with atomic_write(path) as dst:
+            write(dst)
+
+        with self._lock:
+            self._size += os.path.getsize(path) - previous_size
+            over_limit = self._size > self.max_bytes
+
+        if over_limit:
+            self.evict()
+
+        return path
+
+    def evict(self) -> int:
+        """
+            drop the least recently used fragments until the cache is back under low_water * max_bytes
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            size = sum(s for (_, s, _) in entries)
+            target = int(self.max_bytes * self.low_water)
+            removed = 0
+
+            for (path, entry_size, _) in entries:
+                if size <= target:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                size -= entry_size
+                removed += 1
+
+            self._size = size
+
+        return removed
+
+    @property
+    def size(self) -> int:
+        return self._size
@@ -0,0 +1,79 @@
+"""
+response cache for the llm calls
+
+    responses are keyed on the model, its parameters and a hash of the messages sent. modes:
+
+        off         always call the model, nothing is stored
+        record      always call the model, every response is stored ( default, any run can be replayed later )
+        read_write  serve stored responses, call the model and store the response on a miss
+        replay      only serve stored responses, a miss raises LLMCacheMiss ( offline runs / benchmarks )
+"""
+
+import hashlib
+import json
+import time
+import typing
+from typing import List
+
+from fragment_cache import FragmentCache
+
+
+LLM_CACHE_MODES = ("off", "record", "read_write", "replay")
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+def llm_cache_key(*, model: str, params: typing.Dict[str, typing.Any], messages: List[typing.Tuple[str, str]]) -> str:
+    payload = json.dumps({"model": model, "params": params, "messages": messages}, sort_keys=True, ensure_ascii=False)
+
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    def __init__(self, root: str, *, mode: str = "record", max_bytes: int = 256 * 1024 ** 2) -> None:
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"unknown llm cache mode {mode!r}, expected one of {', '.join(LLM_CACHE_MODES)}")
+
+        self.mode = mode
+        # responses are small blobs, the fragment store already gives us atomic writes and lru eviction
+        self.store = FragmentCache(root, max_bytes=max_bytes, extension=".json")
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str) -> typing.Optional[str]:
+        if self.mode not in ("read_write", "replay"):
+            return None
+
+        data = self.store.read_bytes(key)
+
+        if data is None:
+            return None
+
+        return json.loads(data)["text"]
+
+    def record(self, key: str, text: str, *, model: str) -> None:
+        if self.mode == "off":
+            return
+
+        self.store.put_bytes(key, json.dumps({"model": model, "created": time.time(), "text": text}).encode("utf-8"))
+
+    def generate(self, key: str, call: typing.Callable[[], str], *, model: str) -> typing.Tuple[str, bool]:
+        """
+            returns the response text and whether it was served from the cache
+        """
+        cached = self.lookup(key)
+
+        if cached is not None:
+            self.hits += 1
+            return (cached, True)
+
+        if self.mode == "replay":
+            raise LLMCacheMiss(f"no recorded response for {key} ( model {model} )")
+
+        self.misses += 1
+        text = call()
+        self.record(key, text, model=model)
+
+        return (text, False)
@@ -7,30 +7,23 @@ TODO:
         intro to be used ( done -- watermark )
 """
 
-import shutil
+import asyncio
+import functools
 import typing
 from dotenv import load_dotenv
 
 load_dotenv()  # take environment variables from .env.
 
 import tempfile
-from pydub import AudioSegment
-from os import listdir, getenv
+import time
+from os import getenv
 import os
-from os.path import isfile, join
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage
-from langchain.output_parsers import PydanticOutputParser
-from pydantic import BaseModel, Field
+from os.path import join
+from pydantic import BaseModel, Field, ValidationError
 from typing import List
-import openai
-from moviepy.editor import AudioFileClip, ImageClip
-import replicate
-import threading
-import wget
-import json
-import spotdl
+
+# langchain, openai, the azure speech sdk, pydub and numpy are heavy to import ( seconds and a lot of memory ),
+# they are imported by the stages that use them so short jobs and worker processes start quickly
 
 # from langchain.agents import initialize_agent, Tool
 # from langchain.agents import AgentType
@@ -42,12 +35,20 @@ import spotdl
 # from langchain.utilities import WikipediaAPIWrapper
 # from langchain.utilities import DuckDuckGoSearchAPIWrapper
 
-from langchain.document_loaders import PyPDFLoader
-from langchain.chains.summarize import load_summarize_chain
-from langchain.document_loaders import WebBaseLoader
 from mimetypes import MimeTypes
-import urllib
-import azure.cognitiveservices.speech as speechsdk
+import urllib.request
+from tts import AzureSpeechBackend, SpeechBackend, SynthesisJob, SynthesisReport, TTSScheduler
+from fragment_cache import FragmentCache
+from audio import AssemblyStats, AudioAssembler, AudioPart
+from mixer import MusicCue, MusicMixer, normalize_level
+from music_library import MusicLibrary, open_library
+from timeline import TimelineEntry, TimelineRenderer, timeline_dir_for
+from pipeline import PipelineExecutor, StageGraph
+from script_stream import ConversationStreamParser
+from video import download_cover, render_still_videos, video_outputs
+from tracing import tracer
+from llm_cache import LLMResponseCache, llm_cache_key
+from summarize import MapReduceSummarizer, iter_pages
 
 # Define your desired data structure.
 class ConversationPiece(BaseModel):
@@ -79,6 +80,47 @@ class ConversationWithMergedMusic(BaseModel):
     music_to_be_played: List[Music] = Field(description="a list of music to be played depending on the current topic being discussed")
     conversation: List[ConversationPiece | MusicToBePlayed] = Field(description="a list of the conversation segments or music to be played within the podcast")
 
+class MusicInsertion(BaseModel):
+    after_line: int = Field(description="number of the script line the music is played after, -1 to play it before the first line")
+    music_theme: str = Field(description="theme of the music to be played")
+    mode: str = Field(description="whether the music is a background music or not ( background | foreground )")
+    volume_level: float = Field(description="the volume level of the music to be played relative to the expected general volume of the podcast")
+    what_percentage: float = Field(description="the percentage of the music to be played")
+
+class LineRewrite(BaseModel):
+    line: int = Field(description="number of the script line to rewrite")
+    text: str = Field(description="the rewritten line, introducing or acknowledging the music")
+
+class MusicPlacement(BaseModel):
+    music: List[MusicInsertion] = Field(description="the music to be inserted into the script")
+    rewrites: List[LineRewrite] = Field(description="the script lines rewritten to transition to or from the music")
+
+def merge_music_placement(conversation: Conversation, placement: MusicPlacement) -> ConversationWithMergedMusic:
+    rewrites = {r.line: r.text for r in placement.rewrites}
+    insertions: typing.Dict[int, List[MusicToBePlayed]] = {}
+
+    for m in placement.music:
+        # clamp positions the model made up to the ends of the script
+        after_line = min(max(m.after_line, -1), len(conversation.conversation) - 1)
+
+        insertions.setdefault(after_line, []).append(MusicToBePlayed(
+            music_theme=m.music_theme, mode=m.mode, volume_level=m.volume_level, what_percentage=m.what_percentage
+        ))
+
+    merged: List[ConversationPiece | MusicToBePlayed] = list(insertions.get(-1, []))
+
+    for i, piece in enumerate(conversation.conversation):
+        merged.append(piece.copy(update={"line": rewrites[i]}) if i in rewrites else piece)
+        merged.extend(insertions.get(i, []))
+
+    return ConversationWithMergedMusic(
+        title=conversation.title,
+        description=conversation.description,
+        music_theme=conversation.music_theme,
+        music_to_be_played=conversation.music_to_be_played,
+        conversation=merged
+    )
+
 class Participant(BaseModel):
     name: str = Field(description="name of the participant")
     role: str = Field(description="role of the participant")
@@ -88,24 +130,228 @@ class Participant(BaseModel):
 class SponsorMessage(BaseModel):
     message: str = Field(description="the message to be displayed as a sponsor")
 
+class ConversationStreamHandler:
+    """
+        hands out every conversation piece of a streamed script as soon as it is complete
+    """
+
+    def __init__(self, on_piece: typing.Callable[[int, ConversationPiece], None]) -> None:
+        self.parser = ConversationStreamParser()
+        self.on_piece = on_piece
+        self.pieces = 0
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        for obj in self.parser.feed(token):
+            try:
+                piece = ConversationPiece.parse_obj(obj)
+            except ValidationError:
+                continue
+
+            self.on_piece(self.pieces, piece)
+            self.pieces += 1
+
+def as_langchain_callback(handler):
+    """
+        forwards the streamed tokens of a langchain model to a plain handler
+    """
+    from langchain.callbacks.base import BaseCallbackHandler
+
+    class _ForwardTokens(BaseCallbackHandler):
+        def on_llm_new_token(self, token: str, **kwargs) -> None:
+            handler.on_llm_new_token(token)
+
+    return _ForwardTokens()
+
+# the tts pool and the mixer already fan out internally, a second episode in the same stage would only contend with the first
+STAGE_LIMITS = {"llm": 4, "tts": 1, "image": 2, "audio": 1, "video": 1}
+
 class TextToPodcast:
-    def __init__(self) -> None:
-        self.chat_model = ChatOpenAI(
-            openai_api_key=getenv("OPENAI_API_KEY"), model_name="gpt-3.5-turbo-16k",
-            max_tokens=10385,
-            temperature=.9
+    def __init__(
+        self, *,
+        chat_model = None,
+        speech_backend: typing.Optional[SpeechBackend] = None,
+        max_tts_workers: int = 4,
+        fragment_cache: typing.Optional[FragmentCache] = None,
+        music_pass: str = "delta",
+        llm_cache: typing.Optional[LLMResponseCache] = None,
+        video_targets: typing.Sequence[str] = ("square",),
+        music_dir: typing.Optional[str] = None,
+        music_library: typing.Optional[MusicLibrary] = None,
+        stage_limits: typing.Optional[typing.Dict[str, int]] = None
+    ) -> None:
+        # backends are created on first use and then reused, constructing a TextToPodcast is cheap
+        # any chat model with the langchain generate() interface can be passed in, benchmarks use a fake one
+        self._chat_model = chat_model
+        self._speech_backend = speech_backend
+        self._fragment_cache = fragment_cache
+        self._llm_cache = llm_cache
+        self._music_library = music_library
+        self.max_tts_workers = max_tts_workers
+
+        # delta: the music pass only returns insertions + rewritten transitions, full: the whole script is re-emitted
+        self.music_pass = music_pass
+
+        # 24khz mono matches both the watermark and the azure output format, no resampling needed
+        self.audio_assembler = AudioAssembler(sample_rate=24000, channels=1, gap_ms=0, crossfade_ms=100)
+
+        # background beds are ducked under the speech, foreground music plays between lines
+        self.music_mixer = MusicMixer(self.audio_assembler, load=self._load_music)
+
+        # every render keeps its encoded segments and a manifest, edits and ads only re-encode what changed
+        self.timeline_renderer = TimelineRenderer(self.music_mixer)
+        self.music_dir = music_dir or getenv("GRIZZY_MUSIC_DIR")
+
+        # max stages of a kind running at once when episodes share a pipeline executor
+        self.stage_limits = stage_limits if stage_limits is not None else dict(STAGE_LIMITS)
+
+        # any of square | short ( 9:16 ) | landscape ( 16:9 ), all rendered in a single pass over the audio
+        self.video_targets = video_targets
+
+        if getenv("GRIZZY_METRICS_PORT"):
+            try:
+                tracer.serve_metrics(int(getenv("GRIZZY_METRICS_PORT")))
+            except OSError as e:
+                # another worker process already serves the port
+                print(f"metrics endpoint not started: {e}")
+
+    @property
+    def chat_model(self):
+        if self._chat_model is None:
+            from langchain.chat_models import ChatOpenAI
+
+            self._chat_model = ChatOpenAI(
+                openai_api_key=getenv("OPENAI_API_KEY"), model_name="gpt-3.5-turbo-16k",
+                max_tokens=10385,
+                temperature=.9
+            )
+
+        return self._chat_model
+
+    @functools.cached_property
+    def streaming_chat_model(self):
+        # same model, tokens are pushed to callbacks as they arrive
+        return self.chat_model.copy(update={"streaming": True})
+
+    @property
+    def llm_cache(self) -> LLMResponseCache:
+        if self._llm_cache is None:
+            # every response is recorded by default, GRIZZY_LLM_CACHE=replay re-runs a recorded episode offline
+            self._llm_cache = LLMResponseCache(
+                join(getenv("GRIZZY_CACHE_DIR", ".cache"), "llm"),
+                mode = getenv("GRIZZY_LLM_CACHE", "record")
+            )
+
+        return self._llm_cache
+
+    @functools.cached_property
+    def parser(self):
+        from langchain.output_parsers import PydanticOutputParser
+
+        return PydanticOutputParser(pydantic_object=Conversation)
+
+    @functools.cached_property
+    def final_parser(self):
+        from langchain.output_parsers import PydanticOutputParser
+
+        return PydanticOutputParser(pydantic_object=ConversationWithMergedMusic)
+
+    @functools.cached_property
+    def placement_parser(self):
+        from langchain.output_parsers import PydanticOutputParser
+
+        return PydanticOutputParser(pydantic_object=MusicPlacement)
+
+    @property
+    def speech_backend(self) -> SpeechBackend:
+        if self._speech_backend is None:
+            self._speech_backend = AzureSpeechBackend()
+
+        return self._speech_backend
+
+    @property
+    def fragment_cache(self) -> FragmentCache:
+        if self._fragment_cache is None:
+            # synthesized lines are kept across runs, only new or edited lines hit tts
+            self._fragment_cache = FragmentCache(
+                join(getenv("GRIZZY_CACHE_DIR", ".cache"), "fragments"),
+                max_bytes = int(getenv("GRIZZY_FRAGMENT_CACHE_BYTES", 2 * 1024 ** 3))
+            )
+
+        return self._fragment_cache
+
+    @functools.cached_property
+    def tts_scheduler(self) -> TTSScheduler:
+        return TTSScheduler(
+            backend = self.speech_backend,
+            cache = self.fragment_cache,
+            max_workers = self.max_tts_workers,
+            # runs of lines are packed into one ssml request, 0 sends every line on its own
+            batch_chars = int(getenv("GRIZZY_TTS_BATCH_CHARS", "3000"))
         )
-        
-        self.parser = PydanticOutputParser(pydantic_object=Conversation)
-        self.final_parser = PydanticOutputParser(pydantic_object=ConversationWithMergedMusic)
-        self.spotiy_downloader = spotdl.Spotdl(
-            client_id = os.getenv("SPOTIFY_CLIENT_ID"),
-            client_secret = os.getenv("SPOTIFY_CLIENT_SECRET"),
-            no_cache = True,
-            headless = False
+
+    def _llm_cache_key(self, messages: List[typing.Tuple[str, str]], **params) -> str:
+        return llm_cache_key(
+            model=self.chat_model.model_name,
+            params={"temperature": self.chat_model.temperature, "max_tokens": self.chat_model.max_tokens, **params},
+            messages=messages
+        )
+
+    def _generate(self, messages, *, stage: str, callbacks: typing.Optional[List[ConversationStreamHandler]] = None) -> str:
+        """
+            a single chat completion going through the response cache. with callbacks the model is streamed,
+            cached responses are replayed to the callbacks as one token
+        """
+        key = self._llm_cache_key([(m.type, m.content) for m in messages])
+
+        with tracer.span(stage, model=self.chat_model.model_name, streaming=callbacks is not None) as span:
+            def _call() -> str:
+                if callbacks is None:
+                    result = self.chat_model.generate(messages=[messages])
+                else:
+                    result = self.streaming_chat_model.generate(messages=[messages], callbacks=[as_langchain_callback(c) for c in callbacks])
+
+                # streamed completions don't report usage
+                token_usage = (result.llm_output or {}).get("token_usage", {})
+
+                span.set(
+                    prompt_tokens=token_usage.get("prompt_tokens", 0),
+                    completion_tokens=token_usage.get("completion_tokens", 0)
+                )
+
+                return result.generations[0][0].text
+
+            (text, cached) = self.llm_cache.generate(key, _call, model=self.chat_model.model_name)
+
+            span.set(cached=cached, chars=len(text))
+
+        if cached:
+            for callback in callbacks or []:
+                callback.on_llm_new_token(text)
+
+        return text
+
+    @functools.cached_property
+    def summarizer(self) -> MapReduceSummarizer:
+        from langchain.schema import HumanMessage
+
+        def _complete(prompt: str) -> str:
+            return self.chat_model.generate(messages=[[HumanMessage(content=prompt)]]).generations[0][0].text
+
+        # chunk summaries are always served from their cache so re-ingesting an edited document
+        # only summarizes the chunks that changed ( replay stays offline )
+        return MapReduceSummarizer(
+            complete = _complete,
+            cache = LLMResponseCache(
+                join(getenv("GRIZZY_CACHE_DIR", ".cache"), "summaries"),
+                mode = "replay" if self.llm_cache.mode == "replay" else "read_write"
+            ),
+            model = self.chat_model.model_name,
+            max_workers = int(getenv("GRIZZY_SUMMARY_WORKERS", 4)),
+            calls_per_minute = int(getenv("GRIZZY_SUMMARY_CALLS_PER_MINUTE", 60))
         )
 
     # this generates the podcast from a material -- generate a summary showing the key points -- slap audio on top
+    @tracer.wrap("stage.summary")
     def _convert_material_to_podcast(self, *, material_location: str) -> typing.Optional[str]:
         mime = MimeTypes()
 
@@ -113,28 +359,27 @@ class TextToPodcast:
 
         (mime_type, _) = mime.guess_type(url)
 
-        loader = None
+        if mime_type is None and material_location.startswith(("http://", "https://")):
+            mime_type = "text/html"
 
-        if mime_type == "application/pdf":
-            loader = PyPDFLoader(material_location)
+        if mime_type not in ("application/pdf", "text/html"):
+            return None
 
-        elif mime_type == "text/html":
-            loader = WebBaseLoader(material_location)
-        
-        if loader is not None:
-            docs = loader.load()
+        # summary agent, pages are streamed in and the chunks summarized concurrently
+        summary = self.summarizer.summarize(iter_pages(material_location, mime_type))
 
-            # summary agent
-            chain = load_summarize_chain(self.chat_model, chain_type="map_reduce")
-            print(chain.run(docs))
+        print(f"summarized {material_location} into {len(summary)} chars")
 
-        return None
+        return summary
+
+    def _generate_podcast_script(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = [], material: typing.Optional[str] = None, on_piece: typing.Optional[typing.Callable[[int, ConversationPiece], None]] = None) -> ConversationWithMergedMusic:
+        from langchain.prompts import PromptTemplate
+        from langchain.schema import HumanMessage, SystemMessage
 
-    def _generate_podcast_script(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = []) -> ConversationWithMergedMusic:
         sponsors_messages = "\n".join([f"{s.message}" for s in sponsors])
 
         prompt = PromptTemplate(
-            template="Generate a long form podcast script for the following title {title}.The speakers of the podcasts will be {participants}.{sponsors}\n{format_instructions}\n",
+            template="Generate a long form podcast script for the following title {title}.The speakers of the podcasts will be {participants}.{sponsors}{material}\n{format_instructions}\n",
             input_variables=["title"],
             partial_variables={
                 "format_instructions": self.parser.get_format_instructions(),
@@ -145,7 +390,14 @@ class TextToPodcast:
                     SPONSORS MESSAGES
                     ----------------------
                     {sponsors_messages}
-                """.strip() if len(sponsors_messages.strip()) > 0 else ""
+                """.strip() if len(sponsors_messages.strip()) > 0 else "",
+                "material": f"""\n\n
+                The discussion should be based on the source material summarized below. Cover its key points, facts and numbers accurately.
+
+                    SOURCE MATERIAL
+                    ----------------------
+                    {material}
+                """.strip() if material else ""
             }
         )
         
@@ -235,9 +487,25 @@ class TextToPodcast:
             HumanMessage(content=prompt.format_prompt(title=title).to_string())
         ]
 
-        result = self.parser.parse(self.chat_model.generate(messages=[messages]).generations[0][0].text)
+        if on_piece is None:
+            result = self.parser.parse(self._generate(messages, stage="llm.script"))
+        else:
+            # stream the first pass so each line can be synthesized while the rest of the script is generated
+            result = self.parser.parse(self._generate(messages, stage="llm.script", callbacks=[ConversationStreamHandler(on_piece)]))
 
         # get the result then pass it through another pipeline to merge the music with the conversation
+        if self.music_pass == "full":
+            return self._merge_music_full(result)
+
+        return self._merge_music_delta(result)
+
+    def _merge_music_full(self, result: Conversation) -> ConversationWithMergedMusic:
+        """
+            the model re-emits the whole script with the music segments merged in
+        """
+        from langchain.prompts import PromptTemplate
+        from langchain.schema import HumanMessage, SystemMessage
+
         prompt_clean_pipeline = PromptTemplate(
             template = """Given the podcast script below add sections in the conversation to where the music if any should be played. You should maintain the formatting, only introduce the music segments.\n\n{format_instructions}\n\n\n
 
@@ -249,7 +517,7 @@ class TextToPodcast:
             input_variables = [],
             partial_variables = {
                 "format_instructions": self.final_parser.get_format_instructions(),
-                "script": json.dumps(result.json())
+                "script": result.json()
             }
         )
 
@@ -262,13 +530,59 @@ class TextToPodcast:
             HumanMessage(content=prompt_clean_pipeline.format_prompt().to_string())
         ]
 
-        final_script = self.chat_model.generate(messages=[clean_messages]).generations[0][0].text
+        final_script = self._generate(clean_messages, stage="llm.music")
 
         # the final script after the previous check step
         print(final_script)
 
         return self.final_parser.parse(final_script)
     
+    def _merge_music_delta(self, result: Conversation) -> ConversationWithMergedMusic:
+        """
+            the model only returns where the music goes and the few lines that need rewriting,
+            the merge itself happens locally so the script is not generated a second time
+        """
+        from langchain.prompts import PromptTemplate
+        from langchain.schema import HumanMessage, SystemMessage
+
+        script = "\n".join([f"{i}. {piece.speakers_name}: {piece.line}" for i, piece in enumerate(result.conversation)])
+        music = "\n".join([f"- {m.theme} (around line {m.position})" for m in result.music_to_be_played]) or f"- {result.music_theme}"
+
+        prompt_music_pipeline = PromptTemplate(
+            template = """Given the numbered podcast script below decide where the music should be played. Only return the music insertions and the lines that have to be rewritten to smoothly introduce or acknowledge the music, refer to lines by their number. Do not return the rest of the script.\n\n{format_instructions}\n\n\n
+
+                music to place
+                -----------------
+                {music}
+
+                podcast script
+                -----------------
+                {script}
+
+            """.strip(),
+            input_variables = [],
+            partial_variables = {
+                "format_instructions": self.placement_parser.get_format_instructions(),
+                "music": music,
+                "script": script
+            }
+        )
+
+        placement_messages = [
+            SystemMessage(
+                content="""
+                    You are an experienced podcast script editor and programme planner. Place the music ( background or foreground ) within the podcast script supplied by the user. Rewrite only the lines needed for the co-host or host to smoothly introduce the music and for the participants to acknowledge it afterwards, keep the rewrites in the voice of the original speaker. Music MUST be included in the conversation flow. Follow the instructions to the latter.
+                """.strip()
+            ),
+            HumanMessage(content=prompt_music_pipeline.format_prompt().to_string())
+        ]
+
+        placement = self.placement_parser.parse(self._generate(placement_messages, stage="llm.music"))
+
+        print(f"music pass placed {len(placement.music)} music segments and rewrote {len(placement.rewrites)} lines")
+
+        return merge_music_placement(result, placement)
+
     def generate_speech_from_text(self, *, voice: str, text: str, audio_file: str):
         """
             supported voices
@@ -289,136 +603,298 @@ class TextToPodcast:
                 en-GB-ThomasNeural (Male)
         """
         
-        speech_config = speechsdk.SpeechConfig(subscription=os.getenv('SPEECH_KEY'), region=os.getenv('SPEECH_REGION'))
-        
-        audio_config = speechsdk.audio.AudioOutputConfig(
-            use_default_speaker = True,
-            filename = audio_file
-        )
+        self.speech_backend.synthesize(voice=voice, text=text, audio_file=audio_file)
+
+        print("Speech synthesized for text [{}], and the audio was saved to [{}]".format(text, audio_file))
 
-        speech_config.speech_synthesis_voice_name = voice
+    def _generate_podcast_script_with_prefetch(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = [], material: typing.Optional[str] = None) -> ConversationWithMergedMusic:
+        """
+            synthesizes the lines of the first pass while the script is still streaming in. the audio lands in
+            the fragment cache so the final render only has to synthesize lines the music pass rewrote
+        """
+        with tempfile.TemporaryDirectory() as prefetch_dir, self.tts_scheduler.session(streaming=True) as prefetch:
+            def _prefetch(index: int, piece: ConversationPiece):
+                prefetch.submit(SynthesisJob(
+                    index = index,
+                    voice = piece.speaker_voice,
+                    text = piece.line,
+                    audio_file = join(prefetch_dir, f"{index}.wav")
+                ))
+
+            podcast_script = self._generate_podcast_script(
+                title=title,
+                name=name,
+                participants=participants,
+                sponsors=sponsors,
+                material=material,
+                on_piece=_prefetch
+            )
 
-        speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
+            prefetch_report = prefetch.wait()
 
-        speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
+            print(f"prefetched {len(prefetch_report.fragments)} lines while the script was generated ({len(prefetch_report.failures)} failed)")
 
-        if speech_synthesis_result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            print("Speech synthesized for text [{}], and the audio was saved to [{}]".format(text, audio_file))
+        return podcast_script
 
-        elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-            cancellation_details = speech_synthesis_result.cancellation_details
-            print("Speech synthesis canceled: {}".format(cancellation_details.reason))
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                print("Error details: {}".format(cancellation_details.error_details))
-    
+    @tracer.wrap("stage.script")
+    def generate_script(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = [], material_location: typing.Optional[str] = None, stream_tts: bool = False) -> ConversationWithMergedMusic:
+        # the summary of the source material ( pdf or web page ) if any, feeds straight into the script prompt
+        material = self._convert_material_to_podcast(material_location=material_location) if material_location else None
 
-    def generate_podcast_resources(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = []):
+        generate_script = self._generate_podcast_script_with_prefetch if stream_tts else self._generate_podcast_script
 
-        podcast_script = self._generate_podcast_script(
+        return generate_script(
             title=title,
             name=name,
             participants=participants,
-            sponsors=sponsors
+            sponsors=sponsors,
+            material=material
         )
 
-        # print(podcast_script)
+    @tracer.wrap("stage.fragments")
+    def synthesize_fragments(self, *, podcast_script: ConversationWithMergedMusic, fragments_dir: str) -> SynthesisReport:
+        if not os.path.exists(fragments_dir):
+            os.makedirs(fragments_dir)
+
+        # music segments are not synthesized, they are looked up in the local music library at mix time
+        jobs = [
+            SynthesisJob(
+                index = fragment,
+                voice = line.speaker_voice,
+                text = line.line,
+                audio_file = join(fragments_dir, f"{fragment}.wav")
+            ) for fragment, line in enumerate(podcast_script.conversation) if isinstance(line, ConversationPiece)
+        ]
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            if not os.path.exists(join(tmpdirname, "fragments")):
-                os.makedirs(join(tmpdirname, "fragments"))
+        # bounded pool, synthesizers are reused per voice and throttled lines are retried
+        synthesis_report = self.tts_scheduler.run(jobs)
+
+        print(f"synthesized {len(synthesis_report.fragments)}/{len(jobs)} lines ({synthesis_report.cache_hits} from cache, {synthesis_report.retries} retries)")
 
-            threads = []
+        for failure in synthesis_report.failures:
+            print(f"failed to synthesize line {failure.index} after {failure.attempts} attempts [{failure.voice}] {failure.text!r}: {failure.error}")
 
-            # TBD: move the helper functions out of this function
-            def _run_in_replicate(fragment: int, conversation: ConversationPiece):
-                try:
-                    self.generate_speech_from_text(
-                        voice = conversation.speaker_voice,
-                        text = conversation.line,
-                        audio_file = join(tmpdirname, "fragments", f"{fragment}.wav")
-                    )
+        return synthesis_report
 
-                except Exception as e:
-                    print(e)
+    @property
+    def music_library(self) -> typing.Optional[MusicLibrary]:
+        if self._music_library is None and self.music_dir:
+            # the index is persisted, only tracks added since the last run get analysed
+            self._music_library = open_library(
+                self.music_dir,
+                sample_rate = self.audio_assembler.sample_rate,
+                channels = self.audio_assembler.channels,
+                max_clip_bytes = int(getenv("GRIZZY_MUSIC_CLIP_CACHE_BYTES", str(256 * 1024 * 1024)))
+            )
 
-            # def _download_resource_from_spotify(fragment: int, music: MusicToBePlayed):
-            #     # use https://github.com/spotDL/spotify-downloader
-            #     songs = self.spotiy_downloader.search([music.music_theme])
+        return self._music_library
 
-            #     print(songs)
+    def find_music(self, theme: str) -> typing.Optional[str]:
+        if self.music_library is None:
+            return None
 
-            #     (song, path_to_song) = self.spotiy_downloader.download(
-            #         song = songs[0]
-            #     )
+        track = self.music_library.best(theme)
 
-            #     # print((song, path_to_song))
+        return self.music_library.path(track) if track is not None else None
 
-            #     # make the saving a bit advanced. This is for testing only
+    def _load_music(self, path: str) -> bytes:
+        # loudness normalized and kept in memory, a bed reused across episodes is decoded once
+        return self.music_library.load(path)
 
-            #     if song is not None and path_to_song is not None:
-            #         shutil.copy(path_to_song, join(tmpdirname, "fragments", f"{fragment}.mp3"))
+    def music_cues(self, podcast_script: ConversationWithMergedMusic, synthesized: typing.Optional[typing.Iterable[int]] = None) -> List[MusicCue]:
+        """
+            the music segments of the script positioned relative to the synthesized lines ( all of them by default )
+        """
+        synthesized = set(synthesized) if synthesized is not None else {
+            i for i, line in enumerate(podcast_script.conversation) if isinstance(line, ConversationPiece)
+        }
 
+        cues = []
+        before_part = 0
 
-            for fragment, line in enumerate(podcast_script.conversation):
-                if isinstance(line, ConversationPiece):
-                    thread = threading.Thread(target=_run_in_replicate, args=(fragment, line))
-                    thread.start()
+        for i, line in enumerate(podcast_script.conversation):
+            if i in synthesized:
+                before_part += 1
 
-                    threads.append(thread)
+            elif isinstance(line, MusicToBePlayed):
+                path = self.find_music(line.music_theme)
 
-                # elif isinstance(line, MusicToBePlayed):
-                #     # search for music fitting the theme ( just combine for now ) ->> forground ->> fade in then can fade out after the what percentage is done
-                #     # use https://github.com/spotDL/spotify-downloader
-                #     thread = threading.Thread(target=_download_resource_from_spotify, args=(fragment, line))
-                #     thread.start()
+                if path is None:
+                    print(f"no music found for {line.music_theme!r}, skipping it")
+                    continue
 
-                #     threads.append(thread)
-                # else:
-                #     # this handles transitions -- maybe
-                #     print(line)
-            
-            # wait for all the threads to finish
-            for thread in threads:
-                if thread is not None:
-                    thread.join()
+                background = line.mode.strip().lower() == "background"
+                track = self.music_library.track(path)
+
+                cues.append(MusicCue(
+                    path = path,
+                    before_part = before_part,
+                    mode = "background" if background else "foreground",
+                    volume = normalize_level(line.volume_level, 0.3 if background else 0.8),
+                    fraction = normalize_level(line.what_percentage, 1.0),
+                    duration = track.duration if track is not None else None
+                ))
+
+        return cues
+
+    @tracer.wrap("stage.mix")
+    def mix_podcast(self, *, fragments: List[str], audio_file: str, music: List[MusicCue] = []) -> AssemblyStats:
+        """
+            renders the episode as segment aligned mp3 chunks plus a timeline manifest next to audio_file,
+            a re-render only encodes the segments whose lines ( or music ) changed since the last one
+        """
+        cues_at: typing.Dict[int, List[MusicCue]] = {}
+
+        for cue in music:
+            cues_at.setdefault(min(max(cue.before_part, 0), len(fragments)), []).append(cue)
+
+        entries = [TimelineEntry(
+            item = AudioPart(path=join(os.path.dirname(os.path.abspath(__file__)), "watermarks", "introduction.wav"), gap_after_ms=500),
+            kind = "watermark",
+            label = "introduction"
+        )]
+
+        for i in range(len(fragments) + 1):
+            entries += [TimelineEntry(item=cue, kind="music", label=os.path.basename(cue.path)) for cue in cues_at.get(i, [])]
+
+            if i < len(fragments):
+                entries.append(TimelineEntry(item=AudioPart(path=fragments[i]), kind="speech", label=os.path.splitext(os.path.basename(fragments[i]))[0]))
+
+        timeline = self.timeline_renderer.render(entries, timeline_dir=timeline_dir_for(audio_file), audio_file=audio_file)
+        audio_stats = timeline.stats()
+
+        print(f"assembled {len(fragments)} fragments and {len(music)} music cues into {audio_stats.duration_ms / 1000:.1f}s of audio ({len(timeline.segments)} segments)")
 
+        return audio_stats
 
-            # loop through the files in the fragments folder and combine them
-            # have a metadata map for this stuff
-            fragments = sorted(
-                [join(tmpdirname,"fragments", f) for f in listdir(join(tmpdirname, "fragments")) if isfile(join(tmpdirname, "fragments", f))],
-                key=lambda x: int(os.path.basename(x).split(".")[0])
+    @tracer.wrap("image.generate")
+    def generate_cover(self, *, title: str, cover_file: str) -> str:
+        import openai
+
+        openai.api_key = getenv("OPENAI_API_KEY")
+
+        response = openai.Image.create(
+            prompt = title,
+            n = 1,
+            size = "1024x1024"
+        )
+
+        image_url = response['data'][0]['url']
+
+        return download_cover(image_url, cover_file)
+
+    @tracer.wrap("stage.video")
+    def render_video(self, *, title: str, audio_file: str, video_file: str, cover_file: typing.Optional[str] = None) -> typing.Dict[str, str]:
+        """
+            renders one video per target in self.video_targets, the first one is written to video_file
+        """
+        cover_file = cover_file or f"{os.path.splitext(video_file)[0]}.png"
+
+        if not os.path.exists(cover_file):
+            self.generate_cover(title=title, cover_file=cover_file)
+
+        outputs = video_outputs(video_file, self.video_targets)
+
+        # the cover is encoded once and the mp3 is copied as is, no 30fps re-encode
+        render_still_videos(cover=cover_file, audio_file=audio_file, outputs=outputs)
+
+        return outputs
+
+    def episode_graph(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = [], material_location: typing.Optional[str] = None, stream_tts: bool = False, skip_failed_lines: bool = False, output_dir: str = ".", work_dir: str) -> StageGraph:
+        """
+            script -> fragments -> mix -> video, with the cover generated off the script while the lines are synthesized and mixed
+        """
+        graph = StageGraph()
+
+        graph.add("script", lambda: self.generate_script(
+            title=title,
+            name=name,
+            participants=participants,
+            sponsors=sponsors,
+            material_location=material_location,
+            stream_tts=stream_tts
+        ), group="llm")
+
+        def _cover(script: ConversationWithMergedMusic) -> str:
+            cover_file = join(output_dir, f"{script.title}.png")
+
+            # a re-render keeps the episode's artwork ( and doesn't pay for a new image )
+            if os.path.exists(cover_file):
+                return cover_file
+
+            return self.generate_cover(title=script.title, cover_file=cover_file)
+
+        graph.add("cover", _cover, after=["script"], group="image")
+
+        def _fragments(script: ConversationWithMergedMusic) -> SynthesisReport:
+            report = self.synthesize_fragments(podcast_script=script, fragments_dir=join(work_dir, "fragments"))
+
+            if not report.ok and not skip_failed_lines:
+                # an episode with holes in the conversation should not be published by accident
+                raise RuntimeError(f"{len(report.failures)} lines failed to synthesize, pass skip_failed_lines=True to mix the episode without them")
+
+            return report
+
+        graph.add("fragments", _fragments, after=["script"], group="tts")
+
+        def _mix(script: ConversationWithMergedMusic, fragments: SynthesisReport) -> AssemblyStats:
+            # the report keeps the fragment index -> file mapping, lines that failed ( with skip_failed_lines ) are left out
+            return self.mix_podcast(
+                fragments = [fragments.fragments[i] for i in sorted(fragments.fragments)],
+                audio_file = join(output_dir, f"{script.title}.mp3"),
+                music = self.music_cues(script, fragments.fragments)
             )
 
-            # watermark
-            podcast = AudioSegment.from_file(join(os.getcwd(), "watermarks", "introduction.wav")).append(AudioSegment.silent(duration=500))
+        graph.add("mix", _mix, after=["script", "fragments"], group="audio")
 
-            for fragment in map(lambda x: AudioSegment.from_file(x), fragments):
-                podcast = podcast.append(fragment)
+        def _video(script: ConversationWithMergedMusic, mix: AssemblyStats, cover: str) -> typing.Optional[typing.Dict[str, str]]:
+            if mix.frames == 0:
+                return None
 
+            return self.render_video(
+                title = script.title,
+                audio_file = join(output_dir, f"{script.title}.mp3"),
+                video_file = join(output_dir, f"{script.title}.mp4"),
+                cover_file = cover
+            )
 
-            if podcast is not None:
-                podcast.export(f"{podcast_script.title}.mp3", format="mp3")
+        graph.add("video", _video, after=["script", "mix", "cover"], group="video")
 
-                openai.api_key = getenv("OPENAI_API_KEY")
+        return graph
 
-                response = openai.Image.create(
-                    prompt = podcast_script.title,
-                    n = 1,
-                    size = "1024x1024"
-                )
+    async def agenerate_podcast_resources(self, *, executor: typing.Optional[PipelineExecutor] = None, **episode) -> typing.Dict[str, typing.Any]:
+        """
+            renders an episode through the stage graph, pass the same executor to render several episodes
+            concurrently under shared per stage limits
+        """
+        executor = executor or PipelineExecutor(self.stage_limits)
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with tracer.span("episode"):
+                (results, timings) = await executor.run(self.episode_graph(work_dir=tmpdirname, **episode))
+
+        print("stage timings " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items()))
 
-                image_url = response['data'][0]['url']
-                # download the image
+        return results
 
-                audio_clip = AudioFileClip(f"{podcast_script.title}.mp3")
-                image_clip = ImageClip(image_url)
+    def generate_podcast_resources(self, *, name, title, participants: List[Participant], sponsors: List[SponsorMessage] = [], material_location: typing.Optional[str] = None, stream_tts: bool = False, skip_failed_lines: bool = False, output_dir: str = "."):
+        started = time.time()
+
+        results = asyncio.run(self.agenerate_podcast_resources(
+            name=name,
+            title=title,
+            participants=participants,
+            sponsors=sponsors,
+            material_location=material_location,
+            stream_tts=stream_tts,
+            skip_failed_lines=skip_failed_lines,
+            output_dir=output_dir
+        ))
 
-                video_clip = image_clip.set_audio(audio_clip)
-                video_clip.duration = audio_clip.duration
-                video_clip.fps = 30
+        if getenv("GRIZZY_TRACE_FILE"):
+            tracer.write_json(getenv("GRIZZY_TRACE_FILE"), since=started)
 
-                video_clip.write_videofile(f"{podcast_script.title}.mp4")
+        return results
 
 
 # support generation of content that fits tiktok, youtube and regular podcasts ( we want to support dubbing )
@@ -0,0 +1,221 @@
+"""
+music beds and stingers mixed under and between the speech
+
+    the speech of a timeline segment is assembled into a single int16 array and every bed is mixed into its span with one
+    vectorized gain envelope ( volume * fades * ducking ) instead of a pydub overlay per segment. ducking
+    follows the speech energy in 10ms blocks, the bed dips while someone talks and comes back up in the pauses.
+
+    foreground music is a stinger, it plays between two lines and pushes the following speech back.
+    background music is a bed, it starts under the next line and runs until the next music cue, the end
+    of the segment or the end of its share of the track ( what_percentage ), whichever comes first.
+"""
+
+import os
+import typing
+from dataclasses import dataclass
+from typing import List
+
+from audio import AssemblyStats, AudioAssembler, AudioPart, read_pcm
+from tracing import tracer
+
+
+@dataclass
+class MusicCue:
+    path: str
+    # the cue plays right before this part, len(parts) plays it after the last one
+    before_part: int
+    mode: str = "background"
+    volume: float = 0.3
+    # share of the track to play
+    fraction: float = 1.0
+    # length of the track in seconds when known up front ( the music library has it ), lets the timeline
+    # size the segment of a bed without decoding the track
+    duration: typing.Optional[float] = None
+
+
+def normalize_level(value: typing.Optional[float], default: float) -> float:
+    """
+        the llm hands out levels both as 0.3 and as 30 ( percent )
+    """
+    if value is None or value <= 0:
+        return default
+
+    return min(value / 100 if value > 1 else value, 1.0)
+
+
+class MusicMixer:
+    def __init__(
+        self,
+        assembler: AudioAssembler, *,
+        load: typing.Optional[typing.Callable[[str], bytes]] = None,
+        fade_ms: int = 1500,
+        duck_gain: float = 0.25,
+        duck_threshold: float = 0.01,
+        attack_ms: int = 80,
+        release_ms: int = 600,
+        block_ms: int = 10,
+        max_stinger_ms: int = 20000
+    ) -> None:
+        self.assembler = assembler
+        # path -> pcm in the assembler format, the music library hands out cached loudness normalized clips
+        self.load = load
+        self.fade_ms = fade_ms
+        # gain applied to a bed while someone is talking
+        self.duck_gain = duck_gain
+        # block rms ( full scale = 1.0 ) above which a block counts as speech
+        self.duck_threshold = duck_threshold
+        self.attack_ms = attack_ms
+        self.release_ms = release_ms
+        self.block_ms = block_ms
+        self.max_stinger_ms = max_stinger_ms
+
+    @property
+    def sample_rate(self) -> int:
+        return self.assembler.sample_rate
+
+    @property
+    def channels(self) -> int:
+        return self.assembler.channels
+
+    def _frames(self, ms: int) -> int:
+        return self.sample_rate * ms // 1000
+
+    def _load(self, path: str, tracks: dict):
+        """
+            the track as float32 frames x channels in [-1, 1], decoded once per mix
+        """
+        import numpy as np
+
+        if path not in tracks:
+            with tracer.span("audio.decode", path=os.path.basename(path)) as span:
+                pcm = self.load(path) if self.load is not None else read_pcm(path, sample_rate=self.sample_rate, channels=self.channels)
+                span.set(bytes=len(pcm))
+
+            tracks[path] = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.channels).astype(np.float32) / 32768.0
+
+        return tracks[path]
+
+    def _fades(self, frames: int, fade_in: int, fade_out: int):
+        import numpy as np
+
+        envelope = np.ones(frames, dtype=np.float32)
+
+        fade_in = min(fade_in, frames // 2)
+        fade_out = min(fade_out, frames - fade_in)
+
+        if fade_in:
+            envelope[:fade_in] = np.linspace(0.0, 1.0, num=fade_in, endpoint=False, dtype=np.float32)
+        if fade_out:
+            envelope[frames - fade_out:] = np.linspace(1.0, 0.0, num=fade_out, dtype=np.float32)
+
+        return envelope
+
+    def _ducking(self, speech):
+        """
+            per frame gain for a bed under the given int16 speech: duck_gain while talking, 1.0 in the pauses.
+            the duck is held for release_ms after speech stops ( so it does not pump between words ) and the
+            transitions are smoothed over attack_ms, starting slightly ahead of the first word
+        """
+        import numpy as np
+
+        frames = len(speech)
+        block = max(1, self._frames(self.block_ms))
+        blocks = -(-frames // block)
+
+        power = np.square(speech, dtype=np.float32).mean(axis=1) / (32768.0 * 32768.0)
+        power = np.pad(power, (0, blocks * block - frames))
+        active = np.sqrt(power.reshape(blocks, block).mean(axis=1)) > self.duck_threshold
+
+        # a block is held when any of the previous `hold` blocks had speech ( running window over a cumulative sum )
+        hold = max(1, self.release_ms // self.block_ms)
+        counts = np.concatenate(([0], np.cumsum(active)))
+        ends = np.arange(1, blocks + 1)
+        held = counts[ends] - counts[np.maximum(ends - hold, 0)] > 0
+
+        gain = np.where(held, self.duck_gain, 1.0).astype(np.float32)
+
+        smooth = max(1, self.attack_ms // self.block_ms) * 2 + 1
+        gain = np.convolve(np.pad(gain, smooth // 2, mode="edge"), np.full(smooth, 1.0 / smooth, dtype=np.float32), mode="valid")
+
+        centers = np.arange(blocks) * block + block / 2
+
+        return np.interp(np.arange(frames), centers, gain).astype(np.float32)
+
+    def _stinger(self, cue: MusicCue, track) -> bytes:
+        import numpy as np
+
+        frames = max(1, min(len(track), int(len(track) * cue.fraction), self._frames(self.max_stinger_ms)))
+        fade = self._frames(self.fade_ms) // 3
+
+        clip = track[:frames] * (self._fades(frames, fade, fade) * cue.volume)[:, None]
+
+        return np.clip(clip * 32768.0, -32768, 32767).astype(np.int16).tobytes()
+
+    def render(self, sequence: typing.Sequence[typing.Union[AudioPart, str, MusicCue]]) -> typing.Tuple[typing.Any, AssemblyStats, List[typing.Tuple[int, int]]]:
+        """
+            mixes an ordered sequence of parts and music cues ( the position in the sequence counts, before_part
+            is ignored ) into int16 frames x channels. also returns the (start frame, frame count) of every entry
+        """
+        import numpy as np
+
+        stats = AssemblyStats(sample_rate=self.sample_rate, channels=self.channels)
+        tracks: dict = {}
+
+        # stingers become parts of their own, beds are anchored on the part they start under
+        items: List[typing.Union[AudioPart, str]] = []
+        beds: List[typing.Tuple[int, int, MusicCue]] = []
+        music_items: List[int] = []
+        entry_items: typing.Dict[int, int] = {}
+        waiting: List[typing.Tuple[int, MusicCue]] = []
+        last_part = max((entry for entry, item in enumerate(sequence) if not isinstance(item, MusicCue)), default=-1)
+
+        for (entry, item) in enumerate(sequence):
+            if not isinstance(item, MusicCue):
+                beds += [(bed_entry, len(items), cue) for (bed_entry, cue) in waiting]
+                waiting = []
+
+                entry_items[entry] = len(items)
+                items.append(item)
+
+            elif item.mode == "background" and entry < last_part:
+                waiting.append((entry, item))
+
+            else:
+                # background music with no speech left to sit under is played as an outro
+                entry_items[entry] = len(items)
+                music_items.append(len(items))
+                items.append(AudioPart(path=item.path, pcm=self._stinger(item, self._load(item.path, tracks))))
+
+        with tracer.span("audio.mix", beds=len(beds), stingers=len(music_items)) as span:
+            buffer = bytearray()
+
+            for pcm in self.assembler.iter_pcm(items, stats):
+                buffer += pcm
+
+            # writable view over the assembled speech, the beds are added in place
+            mixed = np.frombuffer(buffer, dtype=np.int16).reshape(-1, self.channels)
+
+            placements = {entry: stats.offsets[item] for entry, item in entry_items.items()}
+            boundaries = sorted([stats.offsets[item][0] for item in music_items] + [stats.offsets[item][0] for (_, item, _) in beds])
+            fade = self._frames(self.fade_ms)
+
+            for (entry, item, cue) in beds:
+                track = self._load(cue.path, tracks)
+                start = stats.offsets[item][0]
+                end = next((b for b in boundaries if b > start), stats.frames)
+                frames = max(0, min(end - start, int(len(track) * cue.fraction)))
+
+                placements[entry] = (start, frames)
+
+                if frames == 0:
+                    continue
+
+                region = mixed[start:start + frames]
+                envelope = self._fades(frames, fade, fade) * self._ducking(region) * cue.volume
+
+                bed = region.astype(np.float32) + track[:frames] * envelope[:, None] * 32768.0
+                region[:] = np.clip(bed, -32768, 32767).astype(np.int16)
+
+            span.set(frames=stats.frames)
+
+        return (mixed, stats, [placements[entry] for entry in range(len(sequence))])
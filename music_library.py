@@ -0,0 +1,397 @@
+"""
+local music library
+
+    a directory of licensed tracks is scanned once into a persistent json index ( tags, duration, loudness
+    and a theme description ), later scans only stat the files and analyse the ones that were added or
+    changed. matching a music theme is a bm25 lookup over an in memory inverted index, no network involved.
+
+    the description of a track is built from its tags, its file name and an optional sidecar <track>.txt
+    describing the mood / theme in plain words ( the best way to make a track findable ).
+
+    files that can't be decoded are logged and kept out of the search ( until they change ) instead of failing the scan.
+
+    decoded clips are loudness normalized and kept in an lru cache bounded by max_clip_bytes so the
+    same bed used across episodes ( or a batch worker ) is only decoded once.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import subprocess
+import threading
+import time
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+from audio import find_ffmpeg, read_pcm
+from files import atomic_write
+from tracing import tracer
+
+
+MUSIC_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac", ".m4a")
+
+# bump when the analysis changes, older indexes are rebuilt
+INDEX_VERSION = 1
+
+_STOP_WORDS = frozenset("a an and at by for from in into is it of on or the to with music song track sound sounds".split())
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in _STOP_WORDS:
+            continue
+
+        # crude plural folding, "drums" matches "drum"
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+
+        tokens.append(word)
+
+    return tokens
+
+
+@dataclass
+class Track:
+    path: str
+    size: int
+    mtime: float
+    # mtime of the sidecar description, 0 when there is none
+    sidecar_mtime: float = 0.0
+    duration: float = 0.0
+    # gated rms loudness in dBFS
+    loudness: float = -99.0
+    peak: float = 0.0
+    tags: typing.Dict[str, str] = field(default_factory=dict)
+    description: str = ""
+    # why the file could not be analysed, it stays out of the search until it changes
+    error: str = ""
+
+
+def read_tags(path: str) -> typing.Dict[str, str]:
+    """
+        container tags ( title, artist, genre, comment ... ) through ffmpeg's metadata muxer
+    """
+    try:
+        output = subprocess.run(
+            [find_ffmpeg(), "-hide_banner", "-loglevel", "error", "-i", path, "-f", "ffmetadata", "-"],
+            capture_output=True, text=True, errors="replace", check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+    tags = {}
+
+    for line in output.splitlines():
+        if "=" in line and not line.startswith((";", "[")):
+            (key, value) = line.split("=", 1)
+            tags[key.strip().lower()] = value.strip()
+
+    return tags
+
+
+def measure_loudness(pcm: bytes, *, sample_rate: int, block_ms: int = 400, gate_db: float = -60.0) -> typing.Tuple[float, float]:
+    """
+        (loudness, peak) of 16bit pcm, silent blocks below gate_db are left out so intros / outros don't skew it
+    """
+    import numpy as np
+
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+    if not len(samples):
+        return (-99.0, 0.0)
+
+    # sample_rate counts interleaved samples, the blocks only need to be roughly block_ms long
+    block = min(len(samples), max(1, sample_rate * block_ms // 1000))
+    blocks = len(samples) // block
+    power = np.square(samples[:blocks * block]).reshape(blocks, block).mean(axis=1)
+
+    gated = power[power > 10 ** (gate_db / 10)]
+    loudness = 10 * math.log10(float(gated.mean())) if len(gated) else -99.0
+
+    return (loudness, float(np.abs(samples).max()))
+
+
+class ClipCache:
+    """
+        lru of decoded pcm bounded by the total number of bytes held
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._clips: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        with self._lock:
+            clip = self._clips.get(key)
+
+            if clip is not None:
+                self._clips.move_to_end(key)
+
+            return clip
+
+    def put(self, key: str, clip: bytes) -> None:
+        if len(clip) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._clips.pop(key, None)
+            self.size -= len(previous) if previous is not None else 0
+
+            self._clips[key] = clip
+            self.size += len(clip)
+
+            while self.size > self.max_bytes:
+                (_, evicted) = self._clips.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class MusicLibrary:
+    def __init__(
+        self,
+        root: str, *,
+        index_file: typing.Optional[str] = None,
+        sample_rate: int = 24000,
+        channels: int = 1,
+        target_loudness: float = -20.0,
+        max_clip_bytes: int = 256 * 1024 * 1024,
+        max_workers: int = 4
+    ) -> None:
+        self.root = os.path.abspath(root)
+        # the library folder may be read only, the index lives in the cache dir keyed by the library path
+        self.index_file = index_file or os.path.join(
+            os.getenv("GRIZZY_CACHE_DIR", ".cache"), "music", f"index-{hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:12]}.json"
+        )
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.target_loudness = target_loudness
+        self.max_workers = max_workers
+        self.clips = ClipCache(max_clip_bytes)
+
+        self.tracks: typing.Dict[str, Track] = {}
+        self._postings: typing.Dict[str, typing.Dict[str, int]] = {}
+        self._lengths: typing.Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self._load_index()
+
+    def _load_index(self) -> None:
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if index.get("version") != INDEX_VERSION or index.get("root") != self.root:
+            return
+
+        self.tracks = {track["path"]: Track(**track) for track in index.get("tracks", [])}
+        self._build_postings()
+
+    def _save_index(self) -> None:
+        os.makedirs(os.path.dirname(self.index_file) or ".", exist_ok=True)
+
+        with atomic_write(self.index_file, "w") as f:
+            json.dump({"version": INDEX_VERSION, "root": self.root, "tracks": [asdict(t) for t in self.tracks.values()]}, f)
+
+    def _build_postings(self) -> None:
+        postings: typing.Dict[str, typing.Dict[str, int]] = {}
+        lengths = {}
+
+        for path, track in self.tracks.items():
+            if track.error:
+                continue
+
+            tokens = tokenize(track.description)
+            lengths[path] = len(tokens)
+
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[path] = counts.get(path, 0) + 1
+
+        with self._lock:
+            self._postings = postings
+            self._lengths = lengths
+
+    def _analyse(self, path: str, stat: os.stat_result, sidecar_mtime: float) -> Track:
+        try:
+            return self._analyse_file(path, stat, sidecar_mtime)
+        except ImportError:
+            # a missing decoder is not the file's fault, don't record every track as unreadable
+            raise
+        except Exception as e:
+            # one corrupt file must not take the library down, it is recorded so the next scan does not retry it
+            print(f"failed to analyse music file {path}: {e}")
+
+            return Track(path=path, size=stat.st_size, mtime=stat.st_mtime, sidecar_mtime=sidecar_mtime, error=str(e) or type(e).__name__)
+
+    def _analyse_file(self, path: str, stat: os.stat_result, sidecar_mtime: float) -> Track:
+        full_path = os.path.join(self.root, path)
+
+        with tracer.span("music.analyse", path=os.path.basename(path)) as span:
+            pcm = read_pcm(full_path, sample_rate=self.sample_rate, channels=self.channels)
+            (loudness, peak) = measure_loudness(pcm, sample_rate=self.sample_rate * self.channels)
+            tags = read_tags(full_path)
+
+            description = [tags.get(key, "") for key in ("title", "artist", "album", "genre", "mood", "comment", "description")]
+            description.append(re.sub(r"[_\-.]+", " ", os.path.splitext(path)[0]))
+
+            if sidecar_mtime:
+                with open(os.path.splitext(full_path)[0] + ".txt", errors="replace") as f:
+                    description.append(f.read())
+
+            span.set(bytes=len(pcm))
+
+        return Track(
+            path=path,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            sidecar_mtime=sidecar_mtime,
+            duration=len(pcm) / (2 * self.channels * self.sample_rate),
+            loudness=loudness,
+            peak=peak,
+            tags=tags,
+            description=" ".join(d for d in description if d).strip()
+        )
+
+    def scan(self) -> typing.Tuple[int, int]:
+        """
+            brings the index up to date with the directory, returns (analysed, removed).
+            unchanged files ( same size, mtime and sidecar mtime ) are only stat'ed
+        """
+        with tracer.span("music.scan") as span:
+            found: typing.Dict[str, typing.Tuple[os.stat_result, float]] = {}
+
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    (stem, extension) = os.path.splitext(name)
+
+                    if extension.lower() not in MUSIC_EXTENSIONS:
+                        continue
+
+                    full_path = os.path.join(directory, name)
+                    sidecar = os.path.join(directory, stem + ".txt")
+
+                    found[os.path.relpath(full_path, self.root)] = (
+                        os.stat(full_path),
+                        os.path.getmtime(sidecar) if os.path.exists(sidecar) else 0.0
+                    )
+
+            changed = [
+                path for path, (stat, sidecar_mtime) in found.items()
+                if path not in self.tracks or (self.tracks[path].size, self.tracks[path].mtime, self.tracks[path].sidecar_mtime) != (stat.st_size, stat.st_mtime, sidecar_mtime)
+            ]
+            removed = [path for path in self.tracks if path not in found]
+
+            if changed:
+                with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="music") as executor:
+                    analysed = list(executor.map(lambda path: self._analyse(path, *found[path]), changed))
+
+                for track in analysed:
+                    self.tracks[track.path] = track
+
+            for path in removed:
+                del self.tracks[path]
+
+            if changed or removed:
+                self._build_postings()
+                self._save_index()
+
+            span.set(tracks=len(self.tracks), analysed=len(changed), removed=len(removed))
+
+        return (len(changed), len(removed))
+
+    def search(self, theme: str, *, limit: int = 5) -> List[typing.Tuple[Track, float]]:
+        """
+            bm25 ranking of the tracks against the theme description
+        """
+        with self._lock:
+            postings = self._postings
+            lengths = self._lengths
+
+        if not lengths:
+            return []
+
+        (k1, b) = (1.2, 0.75)
+        average_length = sum(lengths.values()) / len(lengths) or 1.0
+        scores: typing.Dict[str, float] = {}
+
+        for token in set(tokenize(theme)):
+            counts = postings.get(token)
+
+            if not counts:
+                continue
+
+            idf = math.log(1 + (len(lengths) - len(counts) + 0.5) / (len(counts) + 0.5))
+
+            for path, count in counts.items():
+                norm = count + k1 * (1 - b + b * lengths[path] / average_length)
+                scores[path] = scores.get(path, 0.0) + idf * count * (k1 + 1) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+        return [(self.tracks[path], score) for path, score in ranked]
+
+    def best(self, theme: str) -> typing.Optional[Track]:
+        with tracer.span("music.search"):
+            results = self.search(theme, limit=1)
+
+        return results[0][0] if results else None
+
+    def path(self, track: Track) -> str:
+        return os.path.join(self.root, track.path)
+
+    def track(self, path: str) -> typing.Optional[Track]:
+        return self.tracks.get(os.path.relpath(os.path.abspath(path), self.root))
+
+    def load(self, path: str) -> bytes:
+        """
+            the 16bit pcm of a track in the library format, scaled to target_loudness ( without clipping the peak )
+        """
+        path = os.path.abspath(path)
+        clip = self.clips.get(path)
+
+        if clip is not None:
+            return clip
+
+        import numpy as np
+
+        pcm = read_pcm(path, sample_rate=self.sample_rate, channels=self.channels)
+        track = self.track(path)
+
+        (loudness, peak) = (track.loudness, track.peak) if track is not None else measure_loudness(pcm, sample_rate=self.sample_rate * self.channels)
+
+        gain = 10 ** ((self.target_loudness - loudness) / 20) if loudness > -99.0 else 1.0
+
+        if peak > 0:
+            gain = min(gain, 0.98 / peak)
+
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) * gain
+        clip = np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+        self.clips.put(path, clip)
+
+        return clip
+
+
+def open_library(root: str, **kwargs) -> MusicLibrary:
+    """
+        loads the persistent index and picks up the files added ( or changed ) since the last scan
+    """
+    started = time.perf_counter()
+    library = MusicLibrary(root, **kwargs)
+    (analysed, removed) = library.scan()
+
+    failed = sum(1 for track in library.tracks.values() if track.error)
+
+    print(f"music library {root}: {len(library.tracks)} tracks ({analysed} analysed, {removed} removed, {failed} unreadable) in {time.perf_counter() - started:.1f}s")
+
+    return library
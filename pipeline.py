@@ -0,0 +1,118 @@
+"""
+asyncio stage graph for rendering an episode
+
+    every stage is a blocking function run in a worker thread once all the stages it depends on are done,
+    it receives their results as keyword arguments. independent stages overlap ( the cover is generated while
+    the lines are synthesized and mixed ) so an episode takes about as long as its longest path.
+
+        graph = StageGraph()
+        graph.add("script", lambda: ..., group="llm")
+        graph.add("cover", lambda script: ..., after=["script"], group="image")
+        graph.add("fragments", lambda script: ..., after=["script"], group="tts")
+
+        (results, timings) = await PipelineExecutor({"tts": 1}).run(graph)
+
+    stages in the same group share a concurrency limit across every graph run by the executor, so several
+    episodes can go through one executor without e.g. more than one of them hammering the tts service.
+
+    when a stage fails ( or the run itself is cancelled ) every stage that has not started yet is cancelled and
+    the error is raised right away. a stage that is already running can't be interrupted, its thread finishes
+    in the background and its result is dropped.
+"""
+
+import asyncio
+import time
+import typing
+from dataclasses import dataclass, field
+from typing import List
+
+from tracing import tracer
+
+
+@dataclass
+class Stage:
+    name: str
+    run: typing.Callable[..., typing.Any]
+    after: List[str] = field(default_factory=list)
+    # stages of a group share the executor's concurrency limit for it
+    group: typing.Optional[str] = None
+
+
+class StageGraph:
+    def __init__(self) -> None:
+        self.stages: typing.Dict[str, Stage] = {}
+
+    def add(self, name: str, run: typing.Callable[..., typing.Any], *, after: typing.Sequence[str] = (), group: typing.Optional[str] = None) -> None:
+        if name in self.stages:
+            raise ValueError(f"stage {name!r} is already in the graph")
+
+        unknown = [dependency for dependency in after if dependency not in self.stages]
+
+        if unknown:
+            # stages are added in dependency order, which also rules out cycles
+            raise ValueError(f"stage {name!r} depends on unknown stages {unknown}")
+
+        self.stages[name] = Stage(name=name, run=run, after=list(after), group=group)
+
+
+class PipelineExecutor:
+    def __init__(self, limits: typing.Optional[typing.Dict[str, int]] = None) -> None:
+        # group -> max stages of that group running at once, groups without a limit are unbounded
+        self.limits = dict(limits or {})
+        self._semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, group: typing.Optional[str]) -> typing.Optional[asyncio.Semaphore]:
+        if group is None or group not in self.limits:
+            return None
+
+        if group not in self._semaphores:
+            self._semaphores[group] = asyncio.Semaphore(self.limits[group])
+
+        return self._semaphores[group]
+
+    async def _run_stage(self, stage: Stage, tasks: typing.Dict[str, "asyncio.Task"], timings: typing.Dict[str, float]) -> typing.Any:
+        inputs = {dependency: await tasks[dependency] for dependency in stage.after}
+        semaphore = self._semaphore(stage.group)
+
+        if semaphore is not None:
+            waited = time.perf_counter()
+
+            async with semaphore:
+                timings[f"{stage.name}.wait"] = time.perf_counter() - waited
+
+                return await self._call(stage, inputs, timings)
+
+        return await self._call(stage, inputs, timings)
+
+    async def _call(self, stage: Stage, inputs: dict, timings: typing.Dict[str, float]) -> typing.Any:
+        started = time.perf_counter()
+
+        # to_thread runs in a copy of the current context, the stage's spans nest under the caller's span
+        try:
+            return await asyncio.to_thread(stage.run, **inputs)
+        finally:
+            timings[stage.name] = time.perf_counter() - started
+
+    async def run(self, graph: StageGraph) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, float]]:
+        """
+            runs every stage of the graph, returns (stage name -> result, stage name -> seconds). the time a
+            stage waited for its group's limit is reported as <stage>.wait
+        """
+        timings: typing.Dict[str, float] = {}
+        tasks: typing.Dict[str, asyncio.Task] = {}
+
+        with tracer.span("pipeline", stages=len(graph.stages)):
+            for stage in graph.stages.values():
+                tasks[stage.name] = asyncio.create_task(self._run_stage(stage, tasks, timings), name=stage.name)
+
+            try:
+                await asyncio.gather(*tasks.values())
+            except BaseException:
+                for task in tasks.values():
+                    task.cancel()
+
+                # let the cancelled stages unwind
+                await asyncio.gather(*tasks.values(), return_exceptions=True)
+                raise
+
+        return ({name: task.result() for name, task in tasks.items()}, timings)
@@ -0,0 +1,89 @@
+"""
+incremental parsing of a podcast script while the llm is still generating it
+
+    the script is a json document with a top level "conversation" array, every object in
+    that array is handed out as soon as its closing brace arrives so tts can start on it
+    before the rest of the script has been generated.
+"""
+
+import json
+import typing
+from typing import List
+
+
+class ConversationStreamParser:
+    def __init__(self, *, key: str = "conversation") -> None:
+        self.key = key
+        self.count = 0
+
+        self._text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: typing.Optional[str] = None
+        self._last_string_end = 0
+        # stack depth of the conversation array once it has been opened, -1 once it has been closed
+        self._array_depth: typing.Optional[int] = None
+        self._object_start = 0
+
+    def _is_conversation_array(self) -> bool:
+        # only the top level key counts, i.e. `{ ..., "conversation": [`
+        if self._array_depth is not None or self._stack != ["{"] or self._last_string != self.key:
+            return False
+
+        return self._text[self._last_string_end:self._pos].strip() == ":"
+
+    def feed(self, chunk: str) -> List[dict]:
+        """
+            consume the next chunk of tokens and return the conversation objects it completed
+        """
+        self._text += chunk
+        completed = []
+
+        while self._pos < len(self._text):
+            c = self._text[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._last_string = self._text[self._string_start + 1:self._pos]
+                    self._last_string_end = self._pos + 1
+
+            elif c == '"':
+                self._in_string = True
+                self._string_start = self._pos
+
+            elif c == "[":
+                if self._is_conversation_array():
+                    self._array_depth = len(self._stack) + 1
+
+                self._stack.append(c)
+
+            elif c == "{":
+                self._stack.append(c)
+
+                if self._array_depth is not None and len(self._stack) == self._array_depth + 1:
+                    self._object_start = self._pos
+
+            elif c in "]}" and self._stack:
+                self._stack.pop()
+
+                if c == "}" and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    try:
+                        completed.append(json.loads(self._text[self._object_start:self._pos + 1]))
+                        self.count += 1
+                    except json.JSONDecodeError:
+                        pass
+
+                elif c == "]" and self._array_depth is not None and len(self._stack) < self._array_depth:
+                    self._array_depth = -1
+
+            self._pos += 1
+
+        return completed
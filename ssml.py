@@ -0,0 +1,147 @@
+"""
+ssml rendering of the script lines
+
+    reactions such as [laughs] or [clears throat] are turned into speaking styles and pauses instead of
+    being read out, CAPITALISED words become <emphasis>. runs of lines ( across voices ) are packed into a
+    single document so one request synthesizes many short lines, the word boundary events of that request
+    are then used to cut the audio back into one fragment per line.
+"""
+
+import bisect
+import re
+import typing
+from dataclasses import dataclass, field
+from typing import List
+from xml.sax.saxutils import escape, quoteattr
+
+
+# reaction -> (speaking style for the line, pause in ms where the reaction was)
+REACTIONS: typing.Dict[str, typing.Tuple[typing.Optional[str], int]] = {
+    "laughs": ("cheerful", 250),
+    "laughing": ("cheerful", 250),
+    "chuckles": ("cheerful", 150),
+    "giggles": ("cheerful", 150),
+    "excited": ("excited", 0),
+    "sighs": ("sad", 400),
+    "gasps": ("terrified", 300),
+    "whispers": ("whispering", 0),
+    "clears throat": (None, 300),
+    "pause": (None, 500),
+    "music": (None, 500),
+}
+
+# unknown reactions are never read out, they become a short pause
+DEFAULT_REACTION_PAUSE_MS = 300
+
+# shorter all caps words are most likely acronyms ( AI, USA, CEO ) and are left alone
+MIN_EMPHASIS_LETTERS = 4
+
+_SPEAK_OPEN = '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xmlns:mstts="https://www.w3.org/2001/mstts" xml:lang="en-US">'
+_SPEAK_CLOSE = "</speak>"
+
+_TOKENS = re.compile(r"\[([^\]]+)\]|(\b[A-Z][A-Z']{%d,}\b)" % (MIN_EMPHASIS_LETTERS - 1))
+
+
+def line_ssml(voice: str, text: str) -> str:
+    """
+        the <voice> element of a single line
+    """
+    style: typing.Optional[str] = None
+    body = []
+    position = 0
+
+    for match in _TOKENS.finditer(text):
+        body.append(escape(text[position:match.start()]))
+        position = match.end()
+
+        if match.group(1) is not None:
+            (reaction_style, pause_ms) = REACTIONS.get(match.group(1).strip().lower(), (None, DEFAULT_REACTION_PAUSE_MS))
+            style = style or reaction_style
+
+            if pause_ms:
+                body.append(f'<break time="{pause_ms}ms"/>')
+        else:
+            body.append(f'<emphasis level="strong">{escape(match.group(2).lower())}</emphasis>')
+
+    body.append(escape(text[position:]))
+    content = re.sub(r"\s{2,}", " ", "".join(body)).strip()
+
+    if style is not None:
+        content = f'<mstts:express-as style="{style}">{content}</mstts:express-as>'
+
+    return f"<voice name={quoteattr(voice)}>{content}</voice>"
+
+
+def document_size(elements: typing.Iterable[str]) -> int:
+    return len(_SPEAK_OPEN) + len(_SPEAK_CLOSE) + sum(len(element) for element in elements)
+
+
+@dataclass
+class SsmlDocument:
+    ssml: str
+    # (start, end) character offsets of every line's <voice> element in ssml
+    spans: List[typing.Tuple[int, int]] = field(default_factory=list)
+
+
+def build_ssml(lines: typing.Sequence[typing.Tuple[str, str]]) -> SsmlDocument:
+    """
+        one document for (voice, text) lines, every line in its own <voice> element
+    """
+    parts = [_SPEAK_OPEN]
+    spans = []
+    offset = len(_SPEAK_OPEN)
+
+    for (voice, text) in lines:
+        element = line_ssml(voice, text)
+
+        parts.append(element)
+        spans.append((offset, offset + len(element)))
+        offset += len(element)
+
+    parts.append(_SPEAK_CLOSE)
+
+    return SsmlDocument(ssml="".join(parts), spans=spans)
+
+
+def split_frames(
+    spans: typing.Sequence[typing.Tuple[int, int]],
+    words: typing.Iterable[typing.Tuple[int, float, float]],
+    *,
+    frames: int,
+    sample_rate: int
+) -> typing.Tuple[List[typing.Tuple[int, int]], List[int]]:
+    """
+        cuts the audio of a document back into lines using its word boundary events, (text offset, start s, end s).
+        every cut sits halfway through the silence between the last word of a line and the first word of the next.
+
+        returns the (start, end) frames of every line and the lines no word was reported for ( a line of only
+        reactions for instance ), those can't be placed reliably and should be synthesized on their own
+    """
+    starts = [start for (start, _) in spans]
+    bounds: List[typing.List[typing.Optional[float]]] = [[None, None] for _ in spans]
+
+    for (offset, start, end) in words:
+        line = bisect.bisect_right(starts, offset) - 1
+
+        if line < 0 or offset >= spans[line][1]:
+            continue
+
+        (first, last) = bounds[line]
+        bounds[line] = [start if first is None else min(first, start), end if last is None else max(last, end)]
+
+    missing = [line for line, (first, _) in enumerate(bounds) if first is None]
+    cuts = [0]
+    last_end = 0.0
+
+    for line in range(1, len(spans)):
+        if bounds[line - 1][1] is not None:
+            last_end = bounds[line - 1][1]
+
+        next_start = next((bounds[j][0] for j in range(line, len(spans)) if bounds[j][0] is not None), last_end)
+        cut = int((last_end + max(next_start, last_end)) / 2 * sample_rate)
+
+        cuts.append(min(frames, max(cuts[-1], cut)))
+
+    cuts.append(frames)
+
+    return ([(cuts[i], cuts[i + 1]) for i in range(len(spans))], missing)
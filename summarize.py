@@ -0,0 +1,227 @@
+"""
+map reduce summarization of long source material ( books, papers, web pages )
+
+    pages are loaded lazily and cut into chunks on content defined boundaries, so an edit to the
+    document only changes the chunks around it. the map calls run concurrently under a rate limit
+    and every chunk summary is cached by the hash of its content, re-ingesting an edited document
+    only summarizes the chunks that changed.
+"""
+
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import typing
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+from llm_cache import LLMResponseCache, llm_cache_key
+from tracing import tracer
+
+
+MAP_PROMPT = """Write a concise summary of the following, keep the key points, facts, names and numbers:
+
+
+{text}
+
+
+CONCISE SUMMARY:"""
+
+REDUCE_PROMPT = """The following are summaries of consecutive parts of a single document. Combine them into one summary of the whole document, keep the key points, facts, names and numbers:
+
+
+{text}
+
+
+SUMMARY:"""
+
+# seconds a web page may take to respond ( per socket operation ), a stalled host should not hang the script stage
+FETCH_TIMEOUT = 30
+
+
+def _fetch(material_location: str, *, timeout: float) -> typing.Tuple[typing.BinaryIO, str]:
+    """
+        downloads a web material into a temp file, returns it ( rewound ) with the content type the server reported
+    """
+    with urllib.request.urlopen(material_location, timeout=timeout) as response:
+        content_type = response.headers.get_content_type()
+        f = tempfile.TemporaryFile()
+
+        try:
+            shutil.copyfileobj(response, f)
+        except BaseException:
+            f.close()
+            raise
+
+    f.seek(0)
+
+    return (f, content_type)
+
+
+def iter_pages(material_location: str, mime_type: typing.Optional[str], *, timeout: float = FETCH_TIMEOUT) -> typing.Iterator[str]:
+    """
+        yields the text of the material one page at a time, pdf pages are only parsed when they are reached.
+        for web materials the content type the server reports wins over the one guessed from the url
+    """
+    if material_location.startswith(("http://", "https://")):
+        (source, content_type) = _fetch(material_location, timeout=timeout)
+
+        if content_type in ("application/pdf", "text/html"):
+            mime_type = content_type
+    else:
+        source = open(material_location, "rb")
+
+    with source:
+        if mime_type == "application/pdf":
+            from PyPDF2 import PdfReader
+
+            reader = PdfReader(source)
+
+            for page in reader.pages:
+                yield page.extract_text() or ""
+
+        elif mime_type == "text/html":
+            from bs4 import BeautifulSoup
+
+            yield BeautifulSoup(source.read(), "html.parser").get_text("\n")
+
+        else:
+            raise ValueError(f"unsupported material type {mime_type!r} for {material_location}")
+
+
+def iter_chunks(pages: typing.Iterable[str], *, min_chars: int = 4000, max_chars: int = 12000) -> typing.Iterator[str]:
+    """
+        a chunk ends after a line whose hash hits the boundary pattern ( once min_chars is reached ) or at max_chars.
+        the boundaries depend on the content around them and not on the offset, so they resync right after an edit
+    """
+    lines: List[str] = []
+    size = 0
+
+    for page in pages:
+        for line in page.splitlines():
+            line = line.strip()
+
+            if not line:
+                continue
+
+            lines.append(line)
+            size += len(line) + 1
+
+            boundary = hashlib.blake2b(line.encode("utf-8"), digest_size=2).digest()[0] % 8 == 0
+
+            if size >= max_chars or (size >= min_chars and boundary):
+                yield "\n".join(lines)
+                lines = []
+                size = 0
+
+    if lines:
+        yield "\n".join(lines)
+
+
+class RateLimiter:
+    """
+        token bucket, at most `rate` calls per `per` seconds with bursts of up to `rate`
+    """
+
+    def __init__(self, rate: int, per: float = 60.0) -> None:
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+
+                delay = (1 - self._tokens) * self.per / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+class MapReduceSummarizer:
+    def __init__(
+        self, *,
+        complete: typing.Callable[[str], str],
+        cache: LLMResponseCache,
+        model: str,
+        max_workers: int = 4,
+        calls_per_minute: int = 60,
+        max_reduce_chars: int = 12000
+    ) -> None:
+        self.complete = complete
+        self.cache = cache
+        self.model = model
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(calls_per_minute)
+        self.max_reduce_chars = max_reduce_chars
+
+    def _summarize(self, template: str, text: str, *, stage: str) -> str:
+        prompt = template.format(text=text)
+        key = llm_cache_key(model=self.model, params={"stage": stage}, messages=[("human", prompt)])
+
+        with tracer.span(f"llm.summary.{stage}", chars=len(text)) as span:
+            def _call() -> str:
+                span.set(rate_limit_wait=self.rate_limiter.acquire())
+                return self.complete(prompt)
+
+            (summary, cached) = self.cache.generate(key, _call, model=self.model)
+            span.set(cached=cached)
+
+        return summary
+
+    def _map(self, executor: ThreadPoolExecutor, texts: typing.Iterable[str], template: str, *, stage: str) -> List[str]:
+        # only a window of chunks is in flight, the rest of the document is not loaded yet
+        window: typing.Deque[Future] = deque()
+        summaries = []
+
+        for text in texts:
+            if len(window) >= self.max_workers * 2:
+                summaries.append(window.popleft().result())
+
+            window.append(executor.submit(self._summarize, template, text, stage=stage))
+
+        summaries.extend(future.result() for future in window)
+
+        return summaries
+
+    def summarize(self, pages: typing.Iterable[str]) -> str:
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="summarize") as executor:
+            summaries = self._map(executor, iter_chunks(pages), MAP_PROMPT, stage="map")
+
+            # collapse the summaries in groups until they fit in a single reduce call
+            while len(summaries) > 1 and sum(len(s) for s in summaries) > self.max_reduce_chars:
+                groups: List[List[str]] = [[]]
+
+                for summary in summaries:
+                    if groups[-1] and sum(len(s) for s in groups[-1]) + len(summary) > self.max_reduce_chars:
+                        groups.append([])
+
+                    groups[-1].append(summary)
+
+                if len(groups) == len(summaries):
+                    # every summary is too long on its own, reducing further won't make progress
+                    break
+
+                summaries = self._map(executor, ["\n\n".join(group) for group in groups], REDUCE_PROMPT, stage="collapse")
+
+        if not summaries:
+            return ""
+
+        if len(summaries) == 1:
+            return summaries[0]
+
+        return self._summarize(REDUCE_PROMPT, "\n\n".join(summaries), stage="reduce")
@@ -0,0 +1,575 @@
+"""
+episode timeline: segment aligned mp3 chunks plus a manifest
+
+    the episode is cut into segments ( runs of consecutive fragments ), every segment is mixed and encoded on
+    its own into whole mp3 frames and the episode file is the plain concatenation of the chunks. the manifest
+    records the source hash, sample offset and duration of every fragment and the chunk of every segment, so
+
+        - re-rendering after a script edit only encodes the segments whose fragments changed, chunks are
+          content addressed by the segment key and the rest are reused as they are
+        - an ad ( or a new sponsor read ) is encoded once and spliced in between two segments, the episode is
+          re-concatenated without decoding or re-encoding anything else
+
+    segment boundaries are content defined ( like the summary chunks ) so an edit does not move the boundaries
+    of the segments after it, a music bed keeps its whole span inside one segment ( which ends once the
+    lines under it are longer than the bed ).
+
+    chunks are encoded without the bit reservoir so no frame borrows bits from the previous one, and the
+    encoder is primed so the frames of a chunk line up exactly with its samples ( the encoder delay falls in
+    the dropped frames ). the frames still overlap when decoded, the start of a chunk is reconstructed together
+    with the end of whatever chunk precedes it, so every chunk leads in with a few ms of silence ( the same
+    silence its neighbours were encoded against ) and a join never glitches, even between unrelated chunks.
+
+    python timeline.py splice "episode.timeline" ad.mp3 --at-ms 600000 --label acme
+    python timeline.py remove "episode.timeline" --label acme
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import typing
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from os.path import join
+from typing import List
+
+from audio import AssemblyStats, AudioAssembler, AudioPart, find_ffmpeg, read_pcm
+from files import atomic_write
+from mixer import MusicCue, MusicMixer
+from tracing import tracer
+
+
+# bump when the rendering changes, chunks of older manifests are not reused
+TIMELINE_VERSION = 2
+
+# lame's encoder delay plus the mp3 decoder delay, in samples
+ENCODER_DELAY = 576 + 529
+
+# kbps by bitrate index, mpeg 1 and mpeg 2 / 2.5 layer iii
+_BITRATES = {
+    True: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    False: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# sample rates by version bits ( 3 mpeg 1, 2 mpeg 2, 0 mpeg 2.5 )
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_frame_size(sample_rate: int) -> int:
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def iter_mp3_frames(data: bytes) -> typing.Iterator[typing.Tuple[int, int]]:
+    """
+        (byte offset, length) of every layer iii frame in a bare mp3 stream ( no id3 / xing header )
+    """
+    offset = 0
+
+    while offset + 4 <= len(data):
+        header = int.from_bytes(data[offset:offset + 4], "big")
+
+        version = (header >> 19) & 3
+        layer = (header >> 17) & 3
+        bitrate_index = (header >> 12) & 0xF
+        rate_index = (header >> 10) & 3
+
+        if header >> 21 != 0x7FF or version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            raise ValueError(f"lost mp3 frame sync at byte {offset}")
+
+        mpeg1 = version == 3
+        bitrate = _BITRATES[mpeg1][bitrate_index] * 1000
+        length = (144 if mpeg1 else 72) * bitrate // _SAMPLE_RATES[version][rate_index] + ((header >> 9) & 1)
+
+        yield (offset, length)
+        offset += length
+
+
+def lead_in_frames(sample_rate: int) -> int:
+    """
+        silence ahead of the samples of every chunk, whole mp3 frames covering the decoder's overlap with the previous chunk
+    """
+    frame_size = mp3_frame_size(sample_rate)
+
+    return -(-ENCODER_DELAY // frame_size) * frame_size
+
+
+def encode_chunk(pcm: bytes, *, sample_rate: int, channels: int, bitrate: int = 128) -> typing.Tuple[bytes, int]:
+    """
+        encodes 16bit pcm into mp3 frames that can be concatenated with any other chunk, they cover exactly
+        lead_in_frames() of silence followed by the ( silence padded ) samples. returns (frames data, sample frames covered)
+    """
+    frame_size = mp3_frame_size(sample_rate)
+    frame_bytes = frame_size * channels * 2
+
+    if not pcm:
+        return (b"", 0)
+
+    pcm = bytes(lead_in_frames(sample_rate) * channels * 2) + pcm + bytes(-len(pcm) % frame_bytes)
+    frames = len(pcm) // frame_bytes
+
+    # primed so the encoder delay ends on a frame boundary, those leading frames are dropped
+    priming = -ENCODER_DELAY % frame_size
+    skip = (ENCODER_DELAY + priming) // frame_size
+
+    data = subprocess.run(
+        [
+            find_ffmpeg(), "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+            "-c:a", "libmp3lame", "-b:a", f"{bitrate}k", "-reservoir", "0",
+            "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"
+        ],
+        input=bytes(priming * channels * 2) + pcm + bytes(frame_bytes * (skip + 1)),
+        capture_output=True,
+        check=True
+    ).stdout
+
+    spans = list(iter_mp3_frames(data))
+
+    if len(spans) < skip + frames:
+        raise RuntimeError(f"expected {skip + frames} mp3 frames from the encoder, got {len(spans)}")
+
+    (first, last) = (spans[skip], spans[skip + frames - 1])
+
+    return (data[first[0]:last[0] + last[1]], frames * frame_size)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+@dataclass
+class TimelineEntry:
+    item: typing.Union[AudioPart, MusicCue]
+    # speech | watermark | music | ad
+    kind: str = "speech"
+    label: str = ""
+
+
+@dataclass
+class TimelineFragment:
+    kind: str
+    label: str
+    # content hash of the source audio
+    source: str
+    # first sample frame in the episode
+    offset: int
+    frames: int
+
+
+@dataclass
+class TimelineSegment:
+    # hash of everything that goes into the chunk, a segment with the same key renders the same frames
+    key: str
+    # chunk file relative to the timeline dir
+    chunk: str
+    offset: int
+    frames: int
+    byte_offset: int
+    bytes: int
+    fragments: List[TimelineFragment] = field(default_factory=list)
+    # where a spliced ad was asked to go ( ms into the episode without ads ), None for the episode's own segments
+    at_ms: typing.Optional[int] = None
+
+
+@dataclass
+class Timeline:
+    sample_rate: int
+    channels: int
+    bitrate: int
+    # episode file relative to the timeline dir
+    audio_file: str
+    segments: List[TimelineSegment] = field(default_factory=list)
+    version: int = TIMELINE_VERSION
+
+    @property
+    def frames(self) -> int:
+        return sum(segment.frames for segment in self.segments)
+
+    @property
+    def fragments(self) -> List[TimelineFragment]:
+        return [fragment for segment in self.segments for fragment in segment.fragments]
+
+    def stats(self) -> AssemblyStats:
+        return AssemblyStats(
+            sample_rate=self.sample_rate,
+            channels=self.channels,
+            frames=self.frames,
+            offsets=[(f.offset, f.frames) for f in self.fragments if f.kind != "music"]
+        )
+
+    @property
+    def ads(self) -> List[TimelineSegment]:
+        return [segment for segment in self.segments if segment.at_ms is not None]
+
+    def place_ads(self, ads: typing.Sequence[TimelineSegment]) -> List[int]:
+        """
+            puts the ad segments back at the boundaries of the episode's own segments closest to their at_ms,
+            ads at the same boundary keep their order. returns the frame ( without ads ) every ad went in at
+        """
+        content = [segment for segment in self.segments if segment.at_ms is None]
+        boundaries = [0]
+
+        for segment in content:
+            boundaries.append(boundaries[-1] + segment.frames)
+
+        slots: typing.Dict[int, List[TimelineSegment]] = {}
+        positions = []
+
+        for ad in ads:
+            target = ad.at_ms * self.sample_rate // 1000
+            position = min(range(len(boundaries)), key=lambda i: abs(boundaries[i] - target))
+
+            slots.setdefault(position, []).append(ad)
+            positions.append(boundaries[position])
+
+        self.segments = []
+
+        for i in range(len(content) + 1):
+            self.segments += slots.get(i, [])
+
+            if i < len(content):
+                self.segments.append(content[i])
+
+        return positions
+
+    def layout(self) -> None:
+        """
+            recomputes the sample and byte offsets after segments were added or removed
+        """
+        (offset, byte_offset) = (0, 0)
+
+        for segment in self.segments:
+            shift = offset - segment.offset
+
+            for fragment in segment.fragments:
+                fragment.offset += shift
+
+            (segment.offset, segment.byte_offset) = (offset, byte_offset)
+            offset += segment.frames
+            byte_offset += segment.bytes
+
+    def save(self, manifest_file: str) -> None:
+        with atomic_write(manifest_file, "w") as f:
+            json.dump(asdict(self), f, indent=1)
+
+    @classmethod
+    def load(cls, manifest_file: str) -> "Timeline":
+        with open(manifest_file) as f:
+            data = json.load(f)
+
+        segments = [
+            TimelineSegment(**dict(segment, fragments=[TimelineFragment(**f) for f in segment["fragments"]]))
+            for segment in data.pop("segments")
+        ]
+
+        return cls(**data, segments=segments)
+
+
+def plan_segments(
+    entries: typing.Sequence[TimelineEntry],
+    sources: typing.Sequence[str],
+    frames: typing.Sequence[int], *,
+    every: int = 8,
+    max_parts: int = 32
+) -> List[List[int]]:
+    """
+        groups the entries into segments. a segment ends after a speech line whose source hash hits the
+        boundary pattern ( about one in `every` ), after a watermark or ad, or at max_parts. a music cue
+        always starts a segment and a bed is never split, its segment runs until the parts under it cover
+        the bed ( frames holds the length of every part and the played length of every cue )
+    """
+    groups: List[List[int]] = [[]]
+    bed_left = 0
+
+    for (i, entry) in enumerate(entries):
+        if isinstance(entry.item, MusicCue):
+            if groups[-1]:
+                groups.append([])
+
+            groups[-1].append(i)
+            bed_left = frames[i] if entry.item.mode == "background" else 0
+            continue
+
+        groups[-1].append(i)
+
+        if bed_left > 0:
+            # the gaps between the parts are not counted, the segment can only run a bit longer than the bed
+            bed_left -= frames[i]
+
+            if bed_left <= 0:
+                groups.append([])
+
+            continue
+
+        parts = sum(1 for j in groups[-1] if not isinstance(entries[j].item, MusicCue))
+
+        if entry.kind != "speech" or int(sources[i][:8], 16) % every == 0 or parts >= max_parts:
+            groups.append([])
+
+    return [group for group in groups if group]
+
+
+class TimelineRenderer:
+    def __init__(self, mixer: MusicMixer, *, bitrate: int = 128, segment_every: int = 8, max_segment_parts: int = 32, max_workers: int = 4) -> None:
+        self.mixer = mixer
+        self.bitrate = bitrate
+        self.segment_every = segment_every
+        self.max_segment_parts = max_segment_parts
+        self.max_workers = max_workers
+
+    @staticmethod
+    def manifest_file(timeline_dir: str) -> str:
+        return join(timeline_dir, "manifest.json")
+
+    def _source(self, entry: TimelineEntry) -> str:
+        item = entry.item
+
+        if isinstance(item, AudioPart) and item.pcm is not None:
+            return hashlib.blake2b(item.pcm, digest_size=16).hexdigest()
+
+        return file_digest(item.path)
+
+    def _frames(self, entry: TimelineEntry) -> int:
+        """
+            the length of a part, or the played length of a music cue, in sample frames
+        """
+        item = entry.item
+        (sample_rate, channels) = (self.mixer.sample_rate, self.mixer.channels)
+
+        if isinstance(item, MusicCue):
+            if item.duration is None:
+                pcm = self.mixer.load(item.path) if self.mixer.load is not None else read_pcm(item.path, sample_rate=sample_rate, channels=channels)
+                duration = len(pcm) / (2 * channels * sample_rate)
+            else:
+                duration = item.duration
+
+            return int(duration * item.fraction * sample_rate)
+
+        if item.pcm is not None:
+            return len(item.pcm) // (2 * channels)
+
+        try:
+            # the fragments are wavs, their header is enough
+            with wave.open(item.path, "rb") as w:
+                return w.getnframes() * sample_rate // w.getframerate()
+        except (OSError, EOFError, wave.Error):
+            # unknown, under a bed it just keeps the segment open a bit longer
+            return 0
+
+    def _settings(self) -> dict:
+        assembler = self.mixer.assembler
+        mixer = {k: v for k, v in vars(self.mixer).items() if isinstance(v, (int, float))}
+
+        return {
+            "version": TIMELINE_VERSION,
+            "sample_rate": assembler.sample_rate,
+            "channels": assembler.channels,
+            "gap_ms": assembler.gap_ms,
+            "crossfade_ms": assembler.crossfade_ms,
+            "bitrate": self.bitrate,
+            "mixer": mixer,
+        }
+
+    def _segment_key(self, entries: typing.Sequence[TimelineEntry], sources: typing.Sequence[str]) -> str:
+        items = []
+
+        for (entry, source) in zip(entries, sources):
+            if isinstance(entry.item, MusicCue):
+                items.append([entry.kind, source, entry.item.mode, entry.item.volume, entry.item.fraction])
+            else:
+                items.append([entry.kind, source, entry.item.gap_after_ms])
+
+        payload = json.dumps({"settings": self._settings(), "items": items}, sort_keys=True)
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _render_segment(self, timeline_dir: str, entries: typing.Sequence[TimelineEntry], sources: typing.Sequence[str], key: str, previous: typing.Optional[TimelineSegment]) -> TimelineSegment:
+        chunk = join("chunks", f"{key}.mp3")
+        chunk_file = join(timeline_dir, chunk)
+
+        if previous is not None and os.path.exists(chunk_file):
+            # same sources and settings, the chunk on disk already holds these frames
+            return TimelineSegment(
+                key=key, chunk=chunk, offset=0, frames=previous.frames, byte_offset=0, bytes=previous.bytes,
+                fragments=[
+                    TimelineFragment(kind=entry.kind, label=entry.label, source=source, offset=f.offset - previous.offset, frames=f.frames)
+                    for (entry, source, f) in zip(entries, sources, previous.fragments)
+                ]
+            )
+
+        with tracer.span("timeline.segment", entries=len(entries)) as span:
+            (mixed, _, placements) = self.mixer.render([entry.item for entry in entries])
+            (data, frames) = encode_chunk(mixed.tobytes(), sample_rate=self.mixer.sample_rate, channels=self.mixer.channels, bitrate=self.bitrate)
+            lead_in = lead_in_frames(self.mixer.sample_rate)
+
+            with atomic_write(chunk_file) as f:
+                f.write(data)
+            span.set(frames=frames, bytes=len(data))
+
+        return TimelineSegment(
+            key=key, chunk=chunk, offset=0, frames=frames, byte_offset=0, bytes=len(data),
+            fragments=[
+                TimelineFragment(kind=entry.kind, label=entry.label, source=source, offset=lead_in + start, frames=count)
+                for (entry, source, (start, count)) in zip(entries, sources, placements)
+            ]
+        )
+
+    def _write(self, timeline_dir: str, timeline: Timeline) -> None:
+        timeline.layout()
+
+        audio_file = join(timeline_dir, timeline.audio_file)
+
+        # the episode is the chunks back to back, nothing is decoded or re-encoded
+        with tracer.span("timeline.concat", segments=len(timeline.segments)) as span:
+            with atomic_write(audio_file) as f:
+                for segment in timeline.segments:
+                    with open(join(timeline_dir, segment.chunk), "rb") as chunk:
+                        shutil.copyfileobj(chunk, f)
+
+            span.set(bytes=os.path.getsize(audio_file))
+
+        timeline.save(self.manifest_file(timeline_dir))
+
+        # chunks of segments that are no longer part of the episode
+        referenced = {os.path.basename(segment.chunk) for segment in timeline.segments}
+
+        for name in os.listdir(join(timeline_dir, "chunks")):
+            if name.endswith(".mp3") and name not in referenced:
+                os.remove(join(timeline_dir, "chunks", name))
+
+    def load(self, timeline_dir: str) -> typing.Optional[Timeline]:
+        try:
+            timeline = Timeline.load(self.manifest_file(timeline_dir))
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+        return timeline if timeline.version == TIMELINE_VERSION else None
+
+    def render(self, entries: typing.Sequence[TimelineEntry], *, timeline_dir: str, audio_file: str) -> Timeline:
+        """
+            renders the entries into audio_file, only the segments that differ from the previous render in
+            timeline_dir are mixed and encoded
+        """
+        os.makedirs(join(timeline_dir, "chunks"), exist_ok=True)
+
+        previous = self.load(timeline_dir)
+        previous_segments = {segment.key: segment for segment in previous.segments} if previous is not None else {}
+
+        with tracer.span("timeline.render", entries=len(entries)) as span:
+            sources = [self._source(entry) for entry in entries]
+            frames = [self._frames(entry) for entry in entries]
+            groups = plan_segments(entries, sources, frames, every=self.segment_every, max_parts=self.max_segment_parts)
+            keys = [self._segment_key([entries[i] for i in group], [sources[i] for i in group]) for group in groups]
+
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="timeline") as executor:
+                segments = list(executor.map(
+                    lambda group, key: self._render_segment(
+                        timeline_dir, [entries[i] for i in group], [sources[i] for i in group], key, previous_segments.get(key)
+                    ),
+                    groups,
+                    keys
+                ))
+
+            timeline = Timeline(
+                sample_rate=self.mixer.sample_rate,
+                channels=self.mixer.channels,
+                bitrate=self.bitrate,
+                audio_file=os.path.relpath(os.path.abspath(audio_file), os.path.abspath(timeline_dir)),
+                segments=segments
+            )
+
+            # ads spliced into the previous render go back in at the same spot
+            if previous is not None and previous.ads:
+                timeline.place_ads(previous.ads)
+
+            self._write(timeline_dir, timeline)
+
+            span.set(segments=len(segments), reused=sum(1 for key in keys if key in previous_segments), frames=timeline.frames)
+
+        return timeline
+
+    def splice(self, timeline_dir: str, ad_file: str, *, at_ms: int, label: str = "ad") -> Timeline:
+        """
+            inserts an ad at the segment boundary closest to at_ms ( in the episode without ads ), the other chunks
+            are left untouched. the ad is kept in the manifest so later renders of the episode put it back
+        """
+        timeline = self.load(timeline_dir)
+
+        if timeline is None:
+            raise FileNotFoundError(f"no timeline manifest in {timeline_dir}")
+
+        entries = [TimelineEntry(item=AudioPart(path=ad_file), kind="ad", label=label)]
+        sources = [self._source(entries[0])]
+
+        segment = self._render_segment(timeline_dir, entries, sources, self._segment_key(entries, sources), None)
+        segment.at_ms = at_ms
+
+        positions = timeline.place_ads(timeline.ads + [segment])
+
+        self._write(timeline_dir, timeline)
+
+        print(f"spliced {label!r} in at {positions[-1] / timeline.sample_rate:.2f}s")
+
+        return timeline
+
+    def remove(self, timeline_dir: str, *, label: str) -> Timeline:
+        """
+            drops the ad segments with the given label
+        """
+        timeline = self.load(timeline_dir)
+
+        if timeline is None:
+            raise FileNotFoundError(f"no timeline manifest in {timeline_dir}")
+
+        timeline.segments = [
+            segment for segment in timeline.segments
+            if segment.at_ms is None or not all(f.label == label for f in segment.fragments)
+        ]
+
+        self._write(timeline_dir, timeline)
+
+        return timeline
+
+
+def timeline_dir_for(audio_file: str) -> str:
+    return f"{os.path.splitext(audio_file)[0]}.timeline"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="splice ads into ( or out of ) a rendered episode without re-encoding it")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    splice = commands.add_parser("splice")
+    splice.add_argument("timeline_dir")
+    splice.add_argument("ad_file")
+    splice.add_argument("--at-ms", type=int, default=0, help="the ad goes to the segment boundary closest to this")
+    splice.add_argument("--label", default="ad")
+
+    remove = commands.add_parser("remove")
+    remove.add_argument("timeline_dir")
+    remove.add_argument("--label", required=True)
+
+    args = parser.parse_args()
+
+    with open(TimelineRenderer.manifest_file(args.timeline_dir)) as f:
+        manifest = json.load(f)
+
+    renderer = TimelineRenderer(
+        MusicMixer(AudioAssembler(sample_rate=manifest["sample_rate"], channels=manifest["channels"])),
+        bitrate=manifest["bitrate"]
+    )
+
+    if args.command == "splice":
+        renderer.splice(args.timeline_dir, args.ad_file, at_ms=args.at_ms, label=args.label)
+    else:
+        renderer.remove(args.timeline_dir, label=args.label)
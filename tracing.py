@@ -0,0 +1,231 @@
+"""
+stage level tracing and metrics for the podcast pipeline
+
+    every stage ( llm passes, tts fragments, decoding, export, image generation, video ) runs inside a span
+    holding its duration and numeric attributes such as bytes, tokens, retries and queue wait.
+
+        with tracer.span("tts.fragment", voice=voice) as span:
+            ...
+            span.set(bytes=os.path.getsize(audio_file))
+
+    finished spans are kept in a bounded ring for the json trace ( chrome trace event format, open it in
+    https://ui.perfetto.dev ) and folded into per span totals for the prometheus text endpoint. a span is a
+    couple of dict updates under a lock so it is cheap enough to leave on.
+"""
+
+import contextlib
+import contextvars
+import functools
+import http.server
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import typing
+from collections import deque
+
+
+_current_span: contextvars.ContextVar[typing.Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("id", "parent_id", "name", "attrs", "start", "end", "thread_id", "error")
+
+    def __init__(self, id: int, parent_id: typing.Optional[int], name: str, attrs: dict) -> None:
+        self.id = id
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end: typing.Optional[float] = None
+        self.thread_id = threading.get_ident()
+        self.error: typing.Optional[str] = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def add(self, **attrs) -> None:
+        for key, value in attrs.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+
+class _SpanTotals:
+    __slots__ = ("count", "errors", "seconds", "attrs")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.attrs: typing.Dict[str, float] = {}
+
+
+class Tracer:
+    def __init__(self, *, max_spans: int = 100_000, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._ids = itertools.count(1)
+        self._spans: typing.Deque[Span] = deque(maxlen=max_spans)
+        self._totals: typing.Dict[str, _SpanTotals] = {}
+        self._lock = threading.Lock()
+        self._servers: typing.Dict[int, http.server.ThreadingHTTPServer] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs) -> typing.Iterator[Span]:
+        parent = _current_span.get()
+        span = Span(next(self._ids), parent.id if parent is not None else None, name, attrs)
+
+        if not self.enabled:
+            yield span
+            return
+
+        token = _current_span.set(span)
+
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time()
+            self._finish(span)
+
+    def wrap(self, name: str) -> typing.Callable:
+        """
+            decorator running the whole function inside a span
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+
+            totals = self._totals.get(span.name)
+
+            if totals is None:
+                totals = self._totals[span.name] = _SpanTotals()
+
+            totals.count += 1
+            totals.seconds += span.end - span.start
+
+            if span.error is not None:
+                totals.errors += 1
+
+            for key, value in span.attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals.attrs[key] = totals.attrs.get(key, 0) + value
+
+    def spans(self, *, since: typing.Optional[float] = None) -> typing.List[Span]:
+        with self._lock:
+            return [span for span in self._spans if since is None or span.start >= since]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans.clear()
+            self._totals.clear()
+
+    def write_json(self, trace_file: str, *, since: typing.Optional[float] = None) -> None:
+        pid = os.getpid()
+        events = []
+
+        for span in self.spans(since=since):
+            args = dict(span.attrs, span_id=span.id)
+
+            if span.parent_id is not None:
+                args["parent_id"] = span.parent_id
+            if span.error is not None:
+                args["error"] = span.error
+
+            events.append({
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+    def prometheus(self) -> str:
+        with self._lock:
+            totals = {name: (t.count, t.errors, t.seconds, dict(t.attrs)) for name, t in self._totals.items()}
+
+        lines = [
+            "# HELP grizzy_span_seconds time spent in each pipeline span",
+            "# TYPE grizzy_span_seconds summary",
+        ]
+
+        for name, (count, _, seconds, _) in sorted(totals.items()):
+            lines.append(f'grizzy_span_seconds_sum{{span="{name}"}} {seconds:.6f}')
+            lines.append(f'grizzy_span_seconds_count{{span="{name}"}} {count}')
+
+        lines += ["# HELP grizzy_span_errors_total spans that raised", "# TYPE grizzy_span_errors_total counter"]
+
+        for name, (_, errors, _, _) in sorted(totals.items()):
+            lines.append(f'grizzy_span_errors_total{{span="{name}"}} {errors}')
+
+        attr_names = sorted({key for (_, _, _, attrs) in totals.values() for key in attrs})
+
+        for attr in attr_names:
+            metric = "grizzy_span_" + re.sub(r"[^a-zA-Z0-9_]", "_", attr) + "_total"
+            lines += [f"# HELP {metric} sum of the {attr} attribute over all spans", f"# TYPE {metric} counter"]
+
+            for name, (_, _, _, attrs) in sorted(totals.items()):
+                if attr in attrs:
+                    lines.append(f'{metric}{{span="{name}"}} {attrs[attr]}')
+
+        return "\n".join(lines) + "\n"
+
+    def serve_metrics(self, port: int, host: str = "0.0.0.0") -> http.server.ThreadingHTTPServer:
+        """
+            serves the prometheus text format on /metrics from a daemon thread, once per port
+        """
+        if port in self._servers:
+            return self._servers[port]
+
+        tracer = self
+
+        class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = tracer.prometheus().encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+        self._servers[port] = server
+
+        return server
+
+
+# process wide tracer, GRIZZY_TRACING=0 turns the spans into no-ops
+tracer = Tracer(enabled=os.getenv("GRIZZY_TRACING", "1") != "0")
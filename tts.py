@@ -0,0 +1,548 @@
+"""
+text to speech scheduling for the podcast fragments
+
+    the scheduler fans the conversation lines out over a bounded pool of workers,
+    retries throttled / cancelled requests with backoff and reports every line
+    that could not be synthesized instead of just printing the exception.
+
+    backends are pluggable, AzureSpeechBackend talks to the azure speech service
+    while FakeSpeechBackend writes deterministic wavs locally ( tests / benchmarks )
+
+    with batch_chars set, lines are packed into multi voice ssml documents so one request
+    synthesizes a run of lines, the audio is cut back into per line fragments ( and cached
+    per line ) using the word boundary events of the request
+"""
+
+import contextvars
+import hashlib
+import io
+import math
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import typing
+import wave
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import List
+
+from fragment_cache import FragmentCache, fragment_key
+from ssml import build_ssml, document_size, line_ssml, split_frames
+from tracing import tracer
+
+
+class SpeechSynthesisError(Exception):
+    def __init__(self, message: str, *, retryable: bool = False) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@dataclass
+class SynthesisJob:
+    index: int
+    voice: str
+    text: str
+    audio_file: str
+
+
+@dataclass
+class FailedLine:
+    index: int
+    voice: str
+    text: str
+    error: str
+    attempts: int
+
+
+@dataclass
+class SynthesisReport:
+    # fragment index -> path of the synthesized wav
+    fragments: typing.Dict[int, str] = field(default_factory=dict)
+    failures: List[FailedLine] = field(default_factory=list)
+    retries: int = 0
+    cache_hits: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failures) == 0
+
+
+class SpeechBackend:
+    """
+        a backend turns a single line of text into a wav file for a given voice
+        implementations should raise SpeechSynthesisError ( retryable=True for throttling )
+    """
+
+    # used to tell apart fragments rendered with different audio settings
+    output_format = "riff-24khz-16bit-mono-pcm"
+
+    # whether synthesize_batch is implemented
+    supports_batching = False
+
+    def synthesize(self, *, voice: str, text: str, audio_file: str) -> None:
+        raise NotImplementedError
+
+    def synthesize_batch(self, *, lines: typing.Sequence[typing.Tuple[str, str]], audio_files: typing.Sequence[str]) -> List[int]:
+        """
+            synthesizes (voice, text) lines in a single request, one wav per line. returns the positions of
+            the lines that could not be cut out of the batch, those are synthesized on their own
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class AzureSpeechBackend(SpeechBackend):
+    """
+        synthesizers are expensive to build ( each one opens a connection ) so we keep a pool
+        of idle synthesizers per voice and hand them out to the workers
+    """
+
+    # lines are rendered through ssml ( reactions and emphasis ), not as plain text
+    output_format = "riff-24khz-16bit-mono-pcm+ssml"
+    supports_batching = True
+
+    def __init__(self, *, subscription: typing.Optional[str] = None, region: typing.Optional[str] = None) -> None:
+        import azure.cognitiveservices.speech as speechsdk
+
+        self._speechsdk = speechsdk
+        self._subscription = subscription or os.getenv("SPEECH_KEY")
+        self._region = region or os.getenv("SPEECH_REGION")
+        self._idle: typing.Dict[str, "queue.SimpleQueue"] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, voice: str):
+        with self._lock:
+            idle = self._idle.setdefault(voice, queue.SimpleQueue())
+
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            speech_config = self._speechsdk.SpeechConfig(subscription=self._subscription, region=self._region)
+            speech_config.speech_synthesis_voice_name = voice
+            speech_config.set_speech_synthesis_output_format(
+                self._speechsdk.SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm
+            )
+
+            # audio_config=None keeps the audio in memory, we write it out ourselves
+            return self._speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+
+    def _release(self, voice: str, synthesizer) -> None:
+        self._idle[voice].put(synthesizer)
+
+    def _speak(self, voice: str, ssml: str, on_word: typing.Optional[typing.Callable] = None) -> bytes:
+        speechsdk = self._speechsdk
+        synthesizer = self._acquire(voice)
+
+        if on_word is not None:
+            synthesizer.synthesis_word_boundary.connect(on_word)
+
+        try:
+            result = synthesizer.speak_ssml_async(ssml).get()
+        except Exception as e:
+            # the synthesizer might be in a bad state, don't put it back in the pool
+            raise SpeechSynthesisError(str(e), retryable=True) from e
+        finally:
+            if on_word is not None:
+                synthesizer.synthesis_word_boundary.disconnect_all()
+
+        self._release(voice, synthesizer)
+
+        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            return result.audio_data
+
+        if result.reason == speechsdk.ResultReason.Canceled:
+            details = result.cancellation_details
+
+            retryable = details.reason != speechsdk.CancellationReason.Error or details.error_code in (
+                speechsdk.CancellationErrorCode.TooManyRequests,
+                speechsdk.CancellationErrorCode.ServiceUnavailable,
+                speechsdk.CancellationErrorCode.ServiceTimeout,
+                speechsdk.CancellationErrorCode.ConnectionFailure,
+            )
+
+            raise SpeechSynthesisError(
+                f"speech synthesis canceled: {details.reason} {details.error_details or ''}".strip(),
+                retryable=retryable
+            )
+
+        raise SpeechSynthesisError(f"unexpected synthesis result: {result.reason}")
+
+    def synthesize(self, *, voice: str, text: str, audio_file: str) -> None:
+        # reactions and emphasis go through ssml so they are performed and not read out
+        audio_data = self._speak(voice, build_ssml([(voice, text)]).ssml)
+
+        with open(audio_file, "wb") as f:
+            f.write(audio_data)
+
+    def synthesize_batch(self, *, lines: typing.Sequence[typing.Tuple[str, str]], audio_files: typing.Sequence[str]) -> List[int]:
+        document = build_ssml(lines)
+        words: List[typing.Tuple[int, float, float]] = []
+
+        def _on_word(event) -> None:
+            # offsets are in 100ns ticks, the duration is a timedelta on recent sdks
+            duration = event.duration.total_seconds() if hasattr(event.duration, "total_seconds") else event.duration / 1e7
+            start = event.audio_offset / 1e7
+
+            words.append((event.text_offset, start, start + duration))
+
+        audio_data = self._speak(lines[0][0], document.ssml, on_word=_on_word)
+
+        with wave.open(io.BytesIO(audio_data), "rb") as w:
+            params = w.getparams()
+            pcm = w.readframes(w.getnframes())
+
+        frame_size = params.nchannels * params.sampwidth
+        (cuts, missing) = split_frames(document.spans, words, frames=len(pcm) // frame_size, sample_rate=params.framerate)
+
+        for (i, (audio_file, (start, end))) in enumerate(zip(audio_files, cuts)):
+            if i in missing:
+                continue
+
+            with wave.open(audio_file, "wb") as w:
+                w.setparams(params)
+                w.writeframes(pcm[start * frame_size:end * frame_size])
+
+        return missing
+
+    def close(self) -> None:
+        with self._lock:
+            self._idle.clear()
+
+
+class FakeSpeechBackend(SpeechBackend):
+    """
+        writes a deterministic tone for every line, the duration scales with the length of the text.
+        latency and failure_rate can be used to simulate a slow or throttling service
+    """
+
+    supports_batching = True
+
+    def __init__(self, *, sample_rate: int = 24000, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0, ms_per_char: int = 60) -> None:
+        self.sample_rate = sample_rate
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.ms_per_char = ms_per_char
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def synthesize(self, *, voice: str, text: str, audio_file: str) -> None:
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if fail:
+            raise SpeechSynthesisError("fake throttling", retryable=True)
+
+        write_tone_wav(
+            audio_file,
+            seed=f"{voice}:{text}",
+            duration_ms=max(200, len(text) * self.ms_per_char),
+            sample_rate=self.sample_rate
+        )
+
+    def synthesize_batch(self, *, lines: typing.Sequence[typing.Tuple[str, str]], audio_files: typing.Sequence[str]) -> List[int]:
+        # one simulated round trip for the whole batch
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if fail:
+            raise SpeechSynthesisError("fake throttling", retryable=True)
+
+        for ((voice, text), audio_file) in zip(lines, audio_files):
+            write_tone_wav(
+                audio_file,
+                seed=f"{voice}:{text}",
+                duration_ms=max(200, len(text) * self.ms_per_char),
+                sample_rate=self.sample_rate
+            )
+
+        return []
+
+
+def write_tone_wav(audio_file: str, *, seed: str, duration_ms: int, sample_rate: int = 24000) -> None:
+    # the pitch is derived from the seed so the same line always renders the same audio
+    frequency = 200 + int(hashlib.sha1(seed.encode("utf-8")).hexdigest()[:4], 16) % 400
+    frames = sample_rate * duration_ms // 1000
+    step = 2 * math.pi * frequency / sample_rate
+
+    samples = struct.pack(f"<{frames}h", *(int(8000 * math.sin(step * i)) for i in range(frames)))
+
+    with wave.open(audio_file, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(samples)
+
+
+# what a worker returns for every job: (job, attempts, error, cached)
+JobResult = typing.Tuple[SynthesisJob, int, typing.Optional[Exception], bool]
+
+
+def _unlink(audio_file: str) -> None:
+    # the backends write in place, a fragment left over from an older render may still be a hard link into the cache
+    try:
+        os.remove(audio_file)
+    except FileNotFoundError:
+        pass
+
+
+class TTSScheduler:
+    def __init__(
+        self, *,
+        backend: SpeechBackend,
+        cache: typing.Optional[FragmentCache] = None,
+        max_workers: int = 4,
+        max_retries: int = 4,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        batch_chars: int = 0,
+        max_batch_lines: int = 50,
+        first_batch_lines: int = 2
+    ) -> None:
+        self.backend = backend
+        self.cache = cache
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # size limit of a batched ssml document, 0 synthesizes every line on its own
+        self.batch_chars = batch_chars
+        # the service caps the number of <voice> elements per document
+        self.max_batch_lines = max_batch_lines
+        # a streamed session sends its first batch after this many lines so the first audio comes back early,
+        # every following batch may hold twice as many lines ( up to max_batch_lines )
+        self.first_batch_lines = first_batch_lines
+
+    @property
+    def batching(self) -> bool:
+        return self.batch_chars > 0 and self.backend.supports_batching
+
+    def _key(self, job: SynthesisJob) -> str:
+        return fragment_key(voice=job.voice, text=job.text, output_format=self.backend.output_format)
+
+    def _synthesize_job(self, job: SynthesisJob, submitted: typing.Optional[float] = None) -> typing.Tuple[int, typing.Optional[Exception], bool]:
+        with tracer.span("tts.fragment", fragment=str(job.index), voice=job.voice, chars=len(job.text)) as span:
+            if submitted is not None:
+                span.set(queue_wait=time.perf_counter() - submitted)
+
+            (attempts, error, cached) = self._synthesize_cached(job)
+
+            span.set(retries=max(0, attempts - 1), cached=cached, failed=error is not None)
+
+            if error is None:
+                span.set(bytes=os.path.getsize(job.audio_file))
+
+        return (attempts, error, cached)
+
+    def _synthesize_cached(self, job: SynthesisJob) -> typing.Tuple[int, typing.Optional[Exception], bool]:
+        if self.cache is None:
+            return self._synthesize_with_retries(job) + (False,)
+
+        key = self._key(job)
+
+        if self.cache.fetch(key, job.audio_file):
+            return (0, None, True)
+
+        (attempts, error) = self._synthesize_with_retries(job)
+
+        if error is None:
+            self._put_cache(job)
+
+        return (attempts, error, False)
+
+    def _put_cache(self, job: SynthesisJob) -> None:
+        try:
+            self.cache.put(self._key(job), job.audio_file)
+        except OSError as e:
+            # a broken cache should never fail the render
+            print(f"failed to cache fragment {job.index}: {e}")
+
+    def _synthesize_batch(self, jobs: typing.Sequence[SynthesisJob], submitted: typing.Optional[float] = None) -> List[JobResult]:
+        """
+            cached lines are fetched, the rest go out as a single ssml request. lines the batch could not be
+            cut into ( or the whole batch, if it failed ) fall back to one request per line
+        """
+        with tracer.span("tts.batch", lines=len(jobs), chars=sum(len(job.text) for job in jobs)) as span:
+            if submitted is not None:
+                span.set(queue_wait=time.perf_counter() - submitted)
+
+            results: typing.Dict[int, JobResult] = {}
+            misses = []
+
+            for job in jobs:
+                if self.cache is not None and self.cache.fetch(self._key(job), job.audio_file):
+                    results[job.index] = (job, 0, None, True)
+                else:
+                    misses.append(job)
+
+            fallback: List[SynthesisJob] = []
+
+            if misses:
+                for job in misses:
+                    _unlink(job.audio_file)
+
+                (attempts, error, missing) = self._with_retries(lambda: self.backend.synthesize_batch(
+                    lines=[(job.voice, job.text) for job in misses],
+                    audio_files=[job.audio_file for job in misses]
+                ))
+
+                if error is not None:
+                    print(f"batch of {len(misses)} lines failed ({error}), synthesizing them one by one")
+                    fallback = misses
+                else:
+                    fallback = [misses[i] for i in missing]
+                    retries_counted = False
+
+                    for (i, job) in enumerate(misses):
+                        if i in missing:
+                            continue
+
+                        if self.cache is not None:
+                            self._put_cache(job)
+
+                        # the retries of the request are counted once, on its first line
+                        results[job.index] = (job, 1 if retries_counted else attempts, None, False)
+                        retries_counted = True
+
+            for job in fallback:
+                results[job.index] = (job,) + self._synthesize_job(job)
+
+            span.set(cached=sum(1 for (_, _, _, cached) in results.values() if cached), fallback=len(fallback), requests=(1 if misses else 0) + len(fallback))
+
+        return [results[job.index] for job in jobs]
+
+    def _synthesize_with_retries(self, job: SynthesisJob) -> typing.Tuple[int, typing.Optional[Exception]]:
+        _unlink(job.audio_file)
+
+        (attempts, error, _) = self._with_retries(lambda: self.backend.synthesize(voice=job.voice, text=job.text, audio_file=job.audio_file))
+
+        return (attempts, error)
+
+    def _with_retries(self, call: typing.Callable[[], typing.Any]) -> typing.Tuple[int, typing.Optional[Exception], typing.Any]:
+        attempt = 0
+
+        while True:
+            attempt += 1
+
+            try:
+                return (attempt, None, call())
+
+            except Exception as e:
+                retryable = isinstance(e, SpeechSynthesisError) and e.retryable
+
+                if not retryable or attempt > self.max_retries:
+                    return (attempt, e, None)
+
+                # exponential backoff with jitter so the workers don't retry in lock step
+                delay = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+                time.sleep(delay * (0.5 + random.random() / 2))
+
+    def session(self, *, streaming: bool = False) -> "SynthesisSession":
+        """
+            streaming: the jobs trickle in ( off a streamed script ), small batches first instead of waiting for a full one
+        """
+        return SynthesisSession(self, streaming=streaming)
+
+    def run(self, jobs: typing.Iterable[SynthesisJob]) -> SynthesisReport:
+        with self.session() as session:
+            for job in jobs:
+                session.submit(job)
+
+            return session.wait()
+
+
+class SynthesisSession:
+    """
+        lets jobs be submitted while they are still being produced ( e.g. lines parsed off a streamed script )
+    """
+
+    def __init__(self, scheduler: TTSScheduler, *, streaming: bool = False) -> None:
+        self._scheduler = scheduler
+        self._executor = ThreadPoolExecutor(max_workers=scheduler.max_workers, thread_name_prefix="tts")
+        self._futures: typing.Dict[Future, List[SynthesisJob]] = {}
+
+        # lines waiting to fill up the next batch and the size of their ssml document
+        self._pending: List[SynthesisJob] = []
+        self._pending_chars = document_size([])
+        # lines the next batch may hold
+        self._batch_lines = min(scheduler.max_batch_lines, scheduler.first_batch_lines) if streaming else scheduler.max_batch_lines
+
+    def _single(self, jobs: List[SynthesisJob], submitted: float) -> List[JobResult]:
+        return [(jobs[0],) + self._scheduler._synthesize_job(jobs[0], submitted)]
+
+    def _run(self, fn: typing.Callable, jobs: List[SynthesisJob]) -> None:
+        # run in a copy of the caller's context so the fragment spans nest under the caller's span
+        context = contextvars.copy_context()
+
+        self._futures[self._executor.submit(context.run, fn, jobs, time.perf_counter())] = jobs
+
+    def submit(self, job: SynthesisJob) -> None:
+        if not self._scheduler.batching:
+            self._run(self._single, [job])
+            return
+
+        size = len(line_ssml(job.voice, job.text))
+
+        if self._pending and self._pending_chars + size > self._scheduler.batch_chars:
+            self.flush()
+
+        self._pending.append(job)
+        self._pending_chars += size
+
+        if len(self._pending) >= self._batch_lines:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+            sends the lines waiting for a batch right away
+        """
+        if self._pending:
+            self._run(self._scheduler._synthesize_batch, self._pending)
+            self._batch_lines = min(self._scheduler.max_batch_lines, self._batch_lines * 2)
+
+        self._pending = []
+        self._pending_chars = document_size([])
+
+    def wait(self) -> SynthesisReport:
+        self.flush()
+
+        report = SynthesisReport()
+
+        for future in as_completed(list(self._futures)):
+            for (job, attempts, error, cached) in future.result():
+                if cached:
+                    report.cache_hits += 1
+                else:
+                    report.retries += attempts - 1
+
+                if error is None:
+                    report.fragments[job.index] = job.audio_file
+                else:
+                    report.failures.append(FailedLine(
+                        index=job.index, voice=job.voice, text=job.text,
+                        error=str(error), attempts=attempts
+                    ))
+
+        report.failures.sort(key=lambda f: f.index)
+
+        return report
+
+    def __enter__(self) -> "SynthesisSession":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # drop whatever is still queued if the producer blew up
+        self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
@@ -0,0 +1,124 @@
+"""
+still image video rendering
+
+    the podcast video is a single cover image over the episode audio. instead of re-encoding the same
+    frame 30 times a second through moviepy, the cover is scaled and encoded exactly once per aspect ratio
+    target into a short clip ( one keyframe, the rest are empty skip frames, one ffmpeg process for all
+    targets ). every video is then that clip looped for the length of the episode with the mp3 next to it,
+    both stream copied, nothing is decoded or encoded again so a 3 hour episode costs about as much as a
+    3 minute one
+"""
+
+import os
+import subprocess
+import tempfile
+import typing
+import urllib.request
+
+from audio import find_ffmpeg
+from tracing import tracer
+
+
+# target -> (width, height)
+VIDEO_TARGETS = {
+    "square": (1080, 1080),     # regular podcast platforms
+    "short": (1080, 1920),      # tiktok / youtube shorts, 9:16
+    "landscape": (1920, 1080),  # youtube, 16:9
+}
+
+
+def download_cover(url: str, cover_file: str) -> str:
+    urllib.request.urlretrieve(url, cover_file)
+
+    return cover_file
+
+
+def audio_duration(audio_file: str) -> float:
+    """
+        seconds of audio in the file, the packets are only read ( stream copied into nothing ), not decoded
+    """
+    output = subprocess.run(
+        [
+            find_ffmpeg(), "-hide_banner", "-loglevel", "error", "-i", audio_file,
+            "-map", "0:a", "-c", "copy", "-f", "null", "-progress", "pipe:1", "-"
+        ],
+        capture_output=True, text=True, check=True
+    ).stdout
+
+    times = [line.split("=", 1)[1] for line in output.splitlines() if line.startswith("out_time_us=")]
+
+    return int(times[-1]) / 1000000
+
+
+def render_still_videos(*, cover: str, audio_file: str, outputs: typing.Dict[str, str], fps: int = 1, clip_seconds: int = 60) -> None:
+    """
+        outputs maps a target name in VIDEO_TARGETS to the mp4 file it should be written to
+    """
+    if not outputs:
+        return
+
+    unknown = [target for target in outputs if target not in VIDEO_TARGETS]
+
+    if unknown:
+        raise ValueError(f"unknown video targets {unknown}, expected any of {', '.join(VIDEO_TARGETS)}")
+
+    targets = list(outputs.items())
+
+    # fit the cover inside every target and pad the rest, split feeds all of them from one decode
+    filters = [f"[0:v]split={len(targets)}" + "".join(f"[in{i}]" for i in range(len(targets)))]
+
+    for i, (target, _) in enumerate(targets):
+        (width, height) = VIDEO_TARGETS[target]
+
+        filters.append(
+            f"[in{i}]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,format=yuv420p[out{i}]"
+        )
+
+    with tempfile.TemporaryDirectory() as tmpdirname, tracer.span("video.render", targets=",".join(outputs)) as span:
+        frames = {target: os.path.join(tmpdirname, f"{target}.mp4") for (target, _) in targets}
+
+        command = [
+            find_ffmpeg(), "-hide_banner", "-loglevel", "error", "-y",
+            "-loop", "1", "-framerate", str(fps), "-i", cover,
+            "-filter_complex", ";".join(filters),
+        ]
+
+        for i, (target, _) in enumerate(targets):
+            command += [
+                "-map", f"[out{i}]", "-frames:v", str(fps * clip_seconds),
+                "-c:v", "libx264", "-tune", "stillimage", "-preset", "veryfast", "-r", str(fps),
+                # a single keyframe per clip, the remaining frames are skip frames and cost next to nothing
+                "-g", "999999", "-bf", "0", "-x264-params", "scenecut=0",
+                frames[target]
+            ]
+
+        with tracer.span("video.encode_cover"):
+            subprocess.run(command, check=True)
+
+        # -shortest overshoots by up to a clip when the video is stream copied, the length is set explicitly
+        duration = audio_duration(audio_file)
+
+        for (target, video_file) in targets:
+            with tracer.span("video.mux", target=target):
+                subprocess.run([
+                    find_ffmpeg(), "-hide_banner", "-loglevel", "error", "-y",
+                    "-stream_loop", "-1", "-i", frames[target],
+                    "-i", audio_file,
+                    "-map", "0:v", "-map", "1:a", "-c", "copy", "-t", f"{duration:.3f}", "-movflags", "+faststart",
+                    video_file
+                ], check=True)
+
+        span.set(bytes=sum(os.path.getsize(f) for f in outputs.values()))
+
+
+def video_outputs(video_file: str, targets: typing.Sequence[str]) -> typing.Dict[str, str]:
+    """
+        the first target is written to video_file, the others next to it as <name>-<target>.mp4
+    """
+    (stem, extension) = os.path.splitext(video_file)
+
+    return {
+        target: video_file if i == 0 else f"{stem}-{target}{extension or '.mp4'}"
+        for i, target in enumerate(targets)
+    }